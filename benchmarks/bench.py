@@ -0,0 +1,214 @@
+"""
+Throughput benchmarks of mailcalaid mail clients against the fake servers
+
+.. code-block:: sh
+
+  PYTHONPATH=src py benchmarks/bench.py --proto imap --messages 2000 --latency 0.001
+  PYTHONPATH=src py benchmarks/bench.py --proto pop3 --scenario list --scenario download
+
+Every scenario runs against a freshly generated mailbox and in a fresh client process, so that
+the reported peak RSS belongs to the client alone: it is the growth of the client process since it
+started, interpreter and server memory excluded.
+"""
+from datetime import timedelta
+from typing import Callable, Dict
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue as queues
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakeserver import FakeMailServer, generate_mailbox  # noqa: E402
+
+
+def _client(proto: str, host: str, port: int):
+  from mailcalaid.mail import ImapClient, Pop3Client
+  kwargs = dict(host=host, port=port, user="bench", password="bench", ssl=False)
+  return ImapClient(**kwargs) if proto == "imap" else Pop3Client(**kwargs)
+
+
+def _fetch(client, total, headeronly=False, workers=0):
+  messages = client.fetch_messages(1, total, headeronly=headeronly)
+  if workers:
+    from mailcalaid.mail.parallel import parse_in_parallel
+    messages = parse_in_parallel(messages, workers)
+  return messages
+
+
+def bench_list(client, total, cutoff, workers, format) -> int:
+  n = 0
+  for msg in _fetch(client, total, headeronly=True, workers=workers):
+    msg.subject, msg.sender, msg.date
+    n += 1
+  return n
+
+
+def bench_fetch_after(client, total, cutoff, workers, format) -> int:
+  n = 0
+  for msg in client.fetch_messages_after(cutoff, headeronly=True):
+    msg.subject
+    n += 1
+  return n
+
+
+def bench_download(client, total, cutoff, workers, format) -> int:
+  from mailcalaid.mail.sinks import open_sink
+  n = 0
+  with tempfile.TemporaryDirectory() as tmpdir:
+    with open_sink(os.path.join(tmpdir, "bench"), format) as download:
+      for msg in client.fetch_messages(1, total):
+        download.add(msg)
+        n += 1
+  return n
+
+
+def bench_delete_before(client, total, cutoff, workers, format) -> int:
+  client.mark_deleted_before(cutoff)
+  client.flush()
+  return total - client.total_messages
+
+
+def bench_delete_after(client, total, cutoff, workers, format) -> int:
+  client.mark_deleted_after(cutoff)
+  client.flush()
+  return total - client.total_messages
+
+
+def bench_delete_keep(client, total, cutoff, workers, format) -> int:
+  keep = total // 10
+  client.mark_deleted_keep(keep)
+  return total - keep
+
+
+def bench_delete_all(client, total, cutoff, workers, format) -> int:
+  client.mark_deleted_all()
+  client.flush()
+  return total
+
+
+# scenarios take the client, number of messages, cutoff date, number of parsing processes of
+# list (0 to parse inline) and archive format of download
+SCENARIOS: Dict[str, Callable] = {
+  "list": bench_list,
+  "fetch_after": bench_fetch_after,
+  "download": bench_download,
+  "delete_before": bench_delete_before,
+  "delete_after": bench_delete_after,
+  "delete_keep": bench_delete_keep,
+  "delete_all": bench_delete_all,
+}
+
+
+def _peak_rss_kb() -> int:
+  """Peak RSS of this process in kilobytes
+
+  VmHWM is per address space and starts over on exec, while ru_maxrss carries the high-water mark
+  of the parent over fork+exec, so the latter is only a fallback where /proc is unavailable
+  """
+  try:
+    with open("/proc/self/status", "rb") as f:
+      for line in f:
+        if line.startswith(b"VmHWM:"):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  # ru_maxrss is in kilobytes on Linux and bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _run_client(name, proto, host, port, total, cutoff, workers, format, queue):
+  baseline = _peak_rss_kb()
+  client = _client(proto, host, port)
+  started_at = time.perf_counter()
+  n = SCENARIOS[name](client, total, cutoff, workers, format)
+  elapsed = time.perf_counter() - started_at
+  client.close()
+  # growth since the interpreter started, what the scenario itself takes
+  queue.put((n, elapsed, _peak_rss_kb() - baseline))
+
+
+def run(name: str, args) -> dict:
+  messages = generate_mailbox(
+    args.messages,
+    attachment_ratio=args.attachments,
+    seed=args.seed,
+  )
+  # cutoff at 90% of the mailbox, so that "after" covers the newest 10%
+  cutoff = messages[int(len(messages) * 0.9)].internaldate - timedelta(seconds=1)
+  capabilities = ("COMPRESS=DEFLATE",) if args.compress else ()
+  with FakeMailServer(messages, proto=args.proto, latency=args.latency, capabilities=capabilities) as server:
+    # spawn (fork+exec) instead of fork, the client must not share pages of the mailbox held by
+    # the server, its peak RSS is still measured against a baseline as ru_maxrss survives exec
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(
+      target=_run_client,
+      args=(name, args.proto, server.host, server.port, args.messages, cutoff, args.workers, args.format, queue),
+    )
+    proc.start()
+    deadline = time.monotonic() + args.timeout
+    while True:
+      try:
+        n, elapsed, rss = queue.get(timeout=1)
+        break
+      except queues.Empty:
+        if not proc.is_alive() and queue.empty():
+          raise Exception("client of scenario %s exited with code %s" % (name, proc.exitcode))
+        if time.monotonic() > deadline:
+          proc.terminate()
+          raise Exception("client of scenario %s timed out after %s seconds" % (name, args.timeout))
+    proc.join()
+    stats = server.stats
+  return {
+    "scenario": name,
+    "proto": args.proto,
+    "messages": n,
+    "seconds": round(elapsed, 3),
+    "msg_per_sec": round(n / elapsed, 1) if elapsed else 0,
+    "round_trips": stats.round_trips,
+    "bytes_in": stats.bytes_in,
+    "bytes_out": stats.bytes_out,
+    "peak_rss_kb": rss,
+    "commands": stats.commands,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--proto", default="imap", choices=("imap", "pop3"))
+  parser.add_argument("--messages", type=int, default=1000, help="number of messages in the mailbox")
+  parser.add_argument("--attachments", type=float, default=0.1, help="ratio of messages with attachment")
+  parser.add_argument("--latency", type=float, default=0, help="seconds injected before each server response")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--compress", action="store_true", help="advertise COMPRESS=DEFLATE (imap only)")
+  parser.add_argument("--scenario", action="append", choices=SCENARIOS.keys(), help="scenarios to run, default all")
+  parser.add_argument("--workers", type=int, default=0, help="parse messages of list in a process pool")
+  parser.add_argument("--format", default="mbox", help="archive format of download, e.g. mbox.gz, maildir, tar.xz")
+  parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for a scenario")
+  parser.add_argument("--json", action="store_true", help="print results as json lines")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  fmt = "{scenario:14} {messages:>8} {seconds:>9} {msg_per_sec:>10} {round_trips:>11} {bytes_in:>10} {bytes_out:>12} {peak_rss_kb:>12}"
+  if not args.json:
+    print(fmt.format(
+      scenario="scenario", messages="messages", seconds="seconds", msg_per_sec="msg/s",
+      round_trips="round trips", bytes_in="bytes in", bytes_out="bytes out", peak_rss_kb="peak rss kb",
+    ))
+  for name in args.scenario or SCENARIOS.keys():
+    result = run(name, args)
+    if args.json:
+      print(json.dumps(result))
+    else:
+      print(fmt.format(**result))
+
+
+if __name__ == "__main__":
+  main()
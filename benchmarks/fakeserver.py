@@ -0,0 +1,849 @@
+"""
+In-process fake IMAP4/POP3 servers serving synthetic mailboxes
+
+Only the subset of the protocols used by mailcalaid is implemented, good enough for benchmarking
+and exercising the clients locally without a real mail server.
+
+.. code-block:: python
+
+  server = FakeMailServer(generate_mailbox(1000), proto="imap", latency=0.002)
+  server.start()
+  client = ImapClient(host=server.host, port=server.port, user="u", password="p", ssl=False)
+  ...
+  server.stop()
+  print(server.stats)
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, List, Tuple, Set, Optional
+import random
+import re
+import socketserver
+import threading
+import time
+import base64
+import email
+import zlib
+
+CRLF = b"\r\n"
+
+WORDS = (
+  "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+  "et dolore magna aliqua release build deploy review merge issue feature bug fix docs meeting report "
+  "invoice order shipping account password reset weekly digest notification github apache devlake"
+).split()
+
+SENDERS = [
+  ("GitHub", "notifications@github.com"),
+  ("Alice", "alice@example.com"),
+  ("Bob", "bob@example.org"),
+  ("Carol", "carol@example.net"),
+  ("Newsletter", "news@mailer.example.com"),
+  ("Dave", "dave@corp.example.com"),
+]
+
+# (ratio, approximate body size in bytes)
+DEFAULT_SIZE_MIX = ((0.70, 2_000), (0.25, 20_000), (0.05, 200_000))
+
+
+@dataclass
+class FakeMessage:
+  """A message stored in the fake server"""
+  uid: int
+  raw: bytes
+  internaldate: datetime
+  flags: Set[str] = field(default_factory=set)
+  modseq: int = 1
+
+  @property
+  def header(self) -> bytes:
+    idx = self.raw.find(CRLF + CRLF)
+    return self.raw if idx < 0 else self.raw[:idx + 4]
+
+  @property
+  def size(self) -> int:
+    return len(self.raw)
+
+
+def _text(rnd: random.Random, size: int) -> str:
+  lines, line, total = [], [], 0
+  while total < size:
+    word = rnd.choice(WORDS)
+    line.append(word)
+    total += len(word) + 1
+    if len(line) >= 12:
+      lines.append(" ".join(line))
+      line = []
+  lines.append(" ".join(line))
+  return "\r\n".join(lines)
+
+
+def generate_message(
+  rnd: random.Random,
+  seq: int,
+  date: datetime,
+  size: int,
+  attachment: bool,
+) -> bytes:
+  """Generate a synthetic RFC 5322 message"""
+  realname, addr = rnd.choice(SENDERS)
+  subject = "[apache/incubator-devlake] %s %s (PR #%d)" % (rnd.choice(WORDS), rnd.choice(WORDS), seq)
+  headers = [
+    "From: %s <%s>" % (realname, addr),
+    "To: me@example.com",
+    "Subject: %s" % subject,
+    "Date: %s" % format_datetime(date),
+    "Message-ID: <%d.%d@fake.example.com>" % (seq, int(date.timestamp())),
+    "MIME-Version: 1.0",
+  ]
+  body = _text(rnd, size) + "\r\n\r\nhttps://github.com/apache/incubator-devlake/pull/%d" % seq
+  if not attachment:
+    headers.append("Content-Type: text/plain; charset=utf-8")
+    return ("\r\n".join(headers) + "\r\n\r\n" + body + "\r\n").encode()
+  boundary = "----=_fake_%d" % seq
+  payload = base64.encodebytes(rnd.randbytes(size)).decode().replace("\n", "\r\n")
+  headers.append('Content-Type: multipart/mixed; boundary="%s"' % boundary)
+  parts = [
+    "--%s\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n%s\r\n" % (boundary, body),
+    "--%s\r\nContent-Type: application/octet-stream\r\n"
+    "Content-Disposition: attachment; filename=\"file%d.bin\"\r\n"
+    "Content-Transfer-Encoding: base64\r\n\r\n%s" % (boundary, seq, payload),
+    "--%s--\r\n" % boundary,
+  ]
+  return ("\r\n".join(headers) + "\r\n\r\n" + "".join(parts)).encode()
+
+
+def generate_mailbox(
+  count: int,
+  size_mix: Tuple[Tuple[float, int], ...] = DEFAULT_SIZE_MIX,
+  attachment_ratio: float = 0.1,
+  start: datetime = None,
+  step: timedelta = timedelta(minutes=37),
+  seed: int = 0,
+) -> List[FakeMessage]:
+  """Generate a date ordered synthetic mailbox
+
+  :param int count: number of messages
+  :param size_mix: list of (ratio, body size) pairs
+  :param float attachment_ratio: ratio of messages carrying a binary attachment
+  :param datetime start: date of the first message
+  :param timedelta step: time between messages
+  :param int seed: random seed, same seed generates same mailbox
+  """
+  rnd = random.Random(seed)
+  if start is None:
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+  ratios = [r for r, _ in size_mix]
+  sizes = [s for _, s in size_mix]
+  messages = []
+  for i in range(count):
+    date = start + step * i
+    size = rnd.choices(sizes, ratios)[0]
+    raw = generate_message(rnd, i + 1, date, size, rnd.random() < attachment_ratio)
+    messages.append(FakeMessage(uid=i + 1, raw=raw, internaldate=date))
+  return messages
+
+
+@dataclass
+class Stats:
+  """Traffic observed by the fake server"""
+  commands: Dict[str, int] = field(default_factory=dict)
+  bytes_in: int = 0
+  bytes_out: int = 0
+  connections: int = 0
+
+  @property
+  def round_trips(self) -> int:
+    return sum(self.commands.values())
+
+
+class FakeMailServer:
+  """Fake mail server running in a background thread
+
+  :param messages: messages of INBOX, see `generate_mailbox`
+  :param str proto: imap or pop3
+  :param float latency: seconds to wait before answering each command
+  :param dict folders: extra IMAP folders, name to messages
+  :param capabilities: extra IMAP capabilities to advertise
+  """
+
+  def __init__(
+    self,
+    messages: List[FakeMessage],
+    proto: str = "imap",
+    latency: float = 0,
+    folders: Dict[str, List[FakeMessage]] = None,
+    capabilities: Tuple[str, ...] = (),
+    host: str = "127.0.0.1",
+    port: int = 0,
+  ):
+    self.mailboxes = {"INBOX": list(messages)}
+    self.mailboxes.update(folders or {})
+    self.uidnext = {name: max((m.uid for m in msgs), default=0) + 1 for name, msgs in self.mailboxes.items()}
+    self.uidvalidity = 1
+    # CONDSTORE/QRESYNC (RFC 7162) state: highest mod-sequence and expunged (uid, modseq) per mailbox
+    self.highestmodseq = {name: 1 for name in self.mailboxes}
+    self.vanished = {name: [] for name in self.mailboxes}
+    self.proto = proto
+    self.latency = latency
+    self.capabilities = ("IMAP4rev1", "LITERAL+") + tuple(capabilities)
+    self.stats = Stats()
+    self.lock = threading.RLock()
+    handler = ImapHandler if proto == "imap" else Pop3Handler
+    self.tcpserver = socketserver.ThreadingTCPServer((host, port), handler, bind_and_activate=False)
+    self.tcpserver.allow_reuse_address = True
+    self.tcpserver.daemon_threads = True
+    self.tcpserver.server_bind()
+    self.tcpserver.server_activate()
+    self.tcpserver.fake = self
+    self.thread = None
+
+  @property
+  def host(self) -> str:
+    return self.tcpserver.server_address[0]
+
+  @property
+  def port(self) -> int:
+    return self.tcpserver.server_address[1]
+
+  def start(self):
+    self.thread = threading.Thread(target=self.tcpserver.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.tcpserver.shutdown()
+    self.tcpserver.server_close()
+
+  def reset_stats(self):
+    self.stats = Stats()
+
+  def next_modseq(self, mailbox: str) -> int:
+    self.highestmodseq[mailbox] += 1
+    return self.highestmodseq[mailbox]
+
+  def record(self, command: str):
+    with self.lock:
+      self.stats.commands[command] = self.stats.commands.get(command, 0) + 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+  """Counts bytes in and out"""
+  disable_nagle_algorithm = True
+
+  @property
+  def fake(self) -> FakeMailServer:
+    return self.server.fake
+
+  inflate = None
+  deflate = None
+
+  def start_compression(self):
+    """Switch to COMPRESS=DEFLATE, see RFC 4978"""
+    self.inflate = zlib.decompressobj(-15)
+    self.deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    self.inbuf = bytearray()
+
+  def _fill(self) -> bool:
+    data = self.rfile.read1(65536)
+    self.fake.stats.bytes_in += len(data)
+    self.inbuf += self.inflate.decompress(data)
+    return bool(data)
+
+  def readline(self) -> bytes:
+    if self.inflate is None:
+      line = self.rfile.readline()
+      self.fake.stats.bytes_in += len(line)
+      return line
+    while b"\n" not in self.inbuf and self._fill():
+      pass
+    idx = self.inbuf.find(b"\n")
+    size = idx + 1 if idx >= 0 else len(self.inbuf)
+    line = bytes(self.inbuf[:size])
+    del self.inbuf[:size]
+    return line
+
+  def read(self, size: int) -> bytes:
+    if self.inflate is None:
+      data = self.rfile.read(size)
+      self.fake.stats.bytes_in += len(data)
+      return data
+    while len(self.inbuf) < size and self._fill():
+      pass
+    data = bytes(self.inbuf[:size])
+    del self.inbuf[:size]
+    return data
+
+  def write(self, data: bytes):
+    if self.deflate is not None:
+      data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+    self.fake.stats.bytes_out += len(data)
+    self.wfile.write(data)
+
+  def handle(self):
+    self.fake.stats.connections += 1
+    try:
+      self.serve()
+    except (ConnectionError, BrokenPipeError):
+      pass
+
+
+#
+# IMAP4
+#
+
+class ImapError(Exception):
+  pass
+
+
+def tokenize(data: bytes, pos: int = 0, depth: int = 0) -> Tuple[list, int]:
+  """Tokenize IMAP command arguments into atoms/strings and nested lists"""
+  tokens = []
+  size = len(data)
+  while pos < size:
+    c = data[pos:pos+1]
+    if c in (b" ", b"\r", b"\n"):
+      pos += 1
+    elif c == b"(":
+      sub, pos = tokenize(data, pos + 1, depth + 1)
+      tokens.append(sub)
+    elif c == b")":
+      return tokens, pos + 1
+    elif c == b'"':
+      pos += 1
+      buf = bytearray()
+      while data[pos:pos+1] != b'"':
+        if data[pos:pos+1] == b"\\":
+          pos += 1
+        buf += data[pos:pos+1]
+        pos += 1
+      tokens.append(buf.decode())
+      pos += 1
+    elif c == b"{":
+      end = data.index(b"}", pos)
+      n = int(data[pos+1:end].rstrip(b"+"))
+      pos = end + 3
+      tokens.append(data[pos:pos+n].decode())
+      pos += n
+    else:
+      start = pos
+      bracket = 0
+      while pos < size:
+        c = data[pos:pos+1]
+        if c == b"[":
+          bracket += 1
+        elif c == b"]":
+          bracket -= 1
+        elif bracket == 0 and c in (b" ", b"(", b")", b"\r", b"\n"):
+          break
+        pos += 1
+      tokens.append(data[start:pos].decode())
+  return tokens, pos
+
+
+def parse_seqset(seqset: str, maximum: int) -> List[int]:
+  ids = []
+  for part in seqset.split(","):
+    if ":" in part:
+      a, b = part.split(":")
+      a = maximum if a == "*" else int(a)
+      b = maximum if b == "*" else int(b)
+      if a > b:
+        a, b = b, a
+      ids.extend(range(a, b + 1))
+    else:
+      ids.append(maximum if part == "*" else int(part))
+  return ids
+
+
+def format_seqset(ids: List[int]) -> str:
+  """Compact ascending ids into a sequence set like 1:3,7"""
+  ranges = []
+  for i in ids:
+    if ranges and ranges[-1][1] == i - 1:
+      ranges[-1][1] = i
+    else:
+      ranges.append([i, i])
+  return ",".join(str(a) if a == b else "%d:%d" % (a, b) for a, b in ranges)
+
+
+def quote(s: str) -> bytes:
+  return b'"' + s.replace("\\", "\\\\").replace('"', '\\"').encode() + b'"'
+
+
+def literal(data: bytes) -> bytes:
+  return b"{%d}\r\n" % len(data) + data
+
+
+def header_fields(header: bytes, names: List[str], exclude: bool = False) -> bytes:
+  names = {n.lower() for n in names}
+  out = []
+  keep = False
+  for line in header.split(CRLF):
+    if not line:
+      continue
+    if line[:1] in (b" ", b"\t"):
+      if keep:
+        out.append(line)
+      continue
+    name = line.split(b":", 1)[0].decode().lower()
+    keep = (name in names) != exclude
+    if keep:
+      out.append(line)
+  return CRLF.join(out) + CRLF + CRLF
+
+
+IMAP_DATE_FMT = "%d-%b-%Y"
+FLAG_KEYS = {
+  "SEEN": "\\Seen",
+  "DELETED": "\\Deleted",
+  "FLAGGED": "\\Flagged",
+  "ANSWERED": "\\Answered",
+  "DRAFT": "\\Draft",
+}
+
+
+class ImapHandler(_Handler):
+  mailbox: Optional[str] = None
+  enabled: Tuple[str, ...] = ()
+
+  @property
+  def messages(self) -> List[FakeMessage]:
+    return self.fake.mailboxes[self.mailbox]
+
+  def send(self, line: bytes):
+    self.write(line + CRLF)
+
+  def read_command(self) -> Optional[bytes]:
+    line = self.readline()
+    if not line:
+      return None
+    data = line
+    while True:
+      m = re.search(rb"\{(\d+)(\+?)\}\r\n$", line)
+      if not m:
+        return data
+      if not m.group(2):
+        self.send(b"+ Ready for literal")
+      data += self.read(int(m.group(1)))
+      line = self.readline()
+      data += line
+
+  def serve(self):
+    self.send(b"* OK fake IMAP4rev1 server ready")
+    while True:
+      data = self.read_command()
+      if data is None:
+        return
+      tag, _, rest = data.partition(b" ")
+      tag = tag.decode()
+      tokens, _ = tokenize(rest)
+      if not tokens:
+        self.send(tag.encode() + b" BAD empty command")
+        continue
+      command = tokens[0].upper()
+      uid = False
+      if command == "UID":
+        uid = True
+        command = tokens[1].upper()
+        tokens = tokens[1:]
+        self.fake.record("UID " + command)
+      else:
+        self.fake.record(command)
+      handler = getattr(self, "cmd_" + command.replace("-", "_"), None)
+      if handler is None:
+        self.send(tag.encode() + b" BAD unknown command")
+        continue
+      try:
+        with self.fake.lock:
+          status = handler(tag, tokens[1:], uid) or "completed"
+        self.send(("%s OK %s %s" % (tag, command, status)).encode())
+      except ImapError as e:
+        self.send(("%s NO %s" % (tag, e)).encode())
+        continue
+      if command == "COMPRESS":
+        self.start_compression()
+      if command == "LOGOUT":
+        return
+
+  def require_selected(self):
+    if self.mailbox is None:
+      raise ImapError("no mailbox selected")
+
+  def cmd_CAPABILITY(self, tag, args, uid):
+    self.send(b"* CAPABILITY " + " ".join(self.fake.capabilities).encode())
+
+  def cmd_NOOP(self, tag, args, uid):
+    pass
+
+  def cmd_COMPRESS(self, tag, args, uid):
+    if "COMPRESS=DEFLATE" not in self.fake.capabilities or args[0].upper() != "DEFLATE":
+      raise ImapError("compression not supported")
+    if self.deflate is not None:
+      raise ImapError("[COMPRESSIONACTIVE] compression already active")
+
+  def cmd_LOGIN(self, tag, args, uid):
+    self.send(b"* CAPABILITY " + " ".join(self.fake.capabilities).encode())
+
+  def cmd_ENABLE(self, tag, args, uid):
+    enabled = [ext.upper() for ext in args if ext.upper() in self.fake.capabilities]
+    if "QRESYNC" in enabled and "CONDSTORE" not in enabled:
+      enabled.append("CONDSTORE")
+    self.enabled += tuple(enabled)
+    self.send(b"* ENABLED" + "".join(" " + ext for ext in enabled).encode())
+
+  def cmd_LOGOUT(self, tag, args, uid):
+    self.send(b"* BYE logging out")
+
+  def cmd_LIST(self, tag, args, uid):
+    status = None
+    if len(args) > 3 and args[2].upper() == "RETURN" and "LIST-STATUS" in self.fake.capabilities:
+      status = args[3][1]
+    for name in self.fake.mailboxes:
+      self.send(b'* LIST (\\HasNoChildren) "/" ' + quote(name))
+      if status:
+        self.cmd_STATUS(tag, [name, status], uid)
+
+  def cmd_SELECT(self, tag, args, uid):
+    name = args[0]
+    if name not in self.fake.mailboxes:
+      raise ImapError("no such mailbox")
+    self.mailbox = name
+    self.send(b"* %d EXISTS" % len(self.messages))
+    self.send(b"* 0 RECENT")
+    self.send(b"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+    self.send(b"* OK [UIDVALIDITY %d] UIDs valid" % self.fake.uidvalidity)
+    self.send(b"* OK [UIDNEXT %d] predicted next UID" % self.fake.uidnext[name])
+    if "CONDSTORE" in self.fake.capabilities:
+      self.send(b"* OK [HIGHESTMODSEQ %d] highest" % self.fake.highestmodseq[name])
+    params = args[1] if len(args) > 1 else []
+    if len(params) > 1 and params[0].upper() == "QRESYNC" and "QRESYNC" in self.enabled:
+      uidvalidity, modseq = int(params[1][0]), int(params[1][1])
+      if uidvalidity == self.fake.uidvalidity:
+        vanished = [u for u, m in self.fake.vanished[name] if m > modseq]
+        if vanished:
+          self.send(b"* VANISHED (EARLIER) " + ",".join(map(str, vanished)).encode())
+        for seq, msg in enumerate(self.messages, 1):
+          if msg.modseq > modseq:
+            self.send(b"* %d FETCH (UID %d FLAGS (%s) MODSEQ (%d))" % (seq, msg.uid, " ".join(sorted(msg.flags)).encode(), msg.modseq))
+    return "[READ-WRITE]"
+
+  cmd_EXAMINE = cmd_SELECT
+
+  def cmd_STATUS(self, tag, args, uid):
+    name, items = args[0], [i.upper() for i in args[1]]
+    if name not in self.fake.mailboxes:
+      raise ImapError("no such mailbox")
+    messages = self.fake.mailboxes[name]
+    values = {
+      "MESSAGES": len(messages),
+      "RECENT": 0,
+      "UNSEEN": sum(1 for m in messages if "\\Seen" not in m.flags),
+      "UIDNEXT": self.fake.uidnext[name],
+      "UIDVALIDITY": self.fake.uidvalidity,
+      "SIZE": sum(m.size for m in messages),
+    }
+    body = " ".join("%s %d" % (i, values[i]) for i in items if i in values)
+    self.send(b"* STATUS " + quote(name) + (" (%s)" % body).encode())
+
+  def resolve(self, seqset: str, uid: bool) -> List[Tuple[int, FakeMessage]]:
+    """Resolve sequence set to (seq, message) pairs"""
+    messages = self.messages
+    if uid:
+      maximum = messages[-1].uid if messages else 0
+      uids = set(parse_seqset(seqset, maximum))
+      return [(i + 1, m) for i, m in enumerate(messages) if m.uid in uids]
+    result = []
+    for seq in parse_seqset(seqset, len(messages)):
+      if not 1 <= seq <= len(messages):
+        raise ImapError("invalid message sequence number %d" % seq)
+      result.append((seq, messages[seq - 1]))
+    return result
+
+  def fetch_item(self, item: str, msg: FakeMessage) -> bytes:
+    name = item.upper()
+    if name == "UID":
+      return b"UID %d" % msg.uid
+    if name == "FLAGS":
+      return b"FLAGS (" + " ".join(sorted(msg.flags)).encode() + b")"
+    if name == "MODSEQ":
+      return b"MODSEQ (%d)" % msg.modseq
+    if name == "RFC822.SIZE":
+      return b"RFC822.SIZE %d" % msg.size
+    if name == "INTERNALDATE":
+      return b'INTERNALDATE "' + msg.internaldate.strftime("%d-%b-%Y %H:%M:%S %z").encode() + b'"'
+    if name in ("RFC822", "BODY[]", "BODY.PEEK[]"):
+      if not name.startswith("BODY.PEEK"):
+        msg.flags.add("\\Seen")
+      return name.replace(".PEEK", "").encode() + b" " + literal(msg.raw)
+    if name in ("RFC822.HEADER", "BODY[HEADER]", "BODY.PEEK[HEADER]"):
+      return name.replace(".PEEK", "").encode() + b" " + literal(msg.header)
+    m = re.match(r"BODY(?:\.PEEK)?\[HEADER\.FIELDS( \.NOT)? \((.*)\)\]", item, re.I)
+    if m:
+      data = header_fields(msg.header, m.group(2).split(), exclude=bool(m.group(1)))
+      return ("BODY[HEADER.FIELDS%s (%s)] " % (m.group(1) or "", m.group(2).upper())).encode() + literal(data)
+    raise ImapError("unsupported fetch item %s" % item)
+
+  def cmd_FETCH(self, tag, args, uid):
+    self.require_selected()
+    items = args[1] if isinstance(args[1], list) else [args[1]]
+    if uid and "UID" not in (i.upper() for i in items):
+      items = ["UID"] + items
+    changedsince = None
+    if len(args) > 2 and args[2][0].upper() == "CHANGEDSINCE":
+      changedsince = int(args[2][1])
+      if "MODSEQ" not in (i.upper() for i in items):
+        items = items + ["MODSEQ"]
+    for seq, msg in self.resolve(args[0], uid):
+      if changedsince is not None and msg.modseq <= changedsince:
+        continue
+      parts = [self.fetch_item(item, msg) for item in items]
+      self.write(b"* %d FETCH (" % seq + b" ".join(parts) + b")" + CRLF)
+
+  def cmd_STORE(self, tag, args, uid):
+    self.require_selected()
+    op = args[1].upper()
+    flags = args[2] if isinstance(args[2], list) else [args[2]]
+    for seq, msg in self.resolve(args[0], uid):
+      if op.startswith("+FLAGS"):
+        msg.flags.update(flags)
+      elif op.startswith("-FLAGS"):
+        msg.flags.difference_update(flags)
+      else:
+        msg.flags = set(flags)
+      msg.modseq = self.fake.next_modseq(self.mailbox)
+      if not op.endswith(".SILENT"):
+        self.fake_fetch_flags(seq, msg, uid)
+
+  def fake_fetch_flags(self, seq: int, msg: FakeMessage, uid: bool):
+    parts = [self.fetch_item("FLAGS", msg)]
+    if uid:
+      parts.insert(0, self.fetch_item("UID", msg))
+    self.send(b"* %d FETCH (" % seq + b" ".join(parts) + b")")
+
+  def expunge(self, silent: bool = False):
+    messages = self.messages
+    seq = 1
+    while seq <= len(messages):
+      if "\\Deleted" in messages[seq - 1].flags:
+        msg = messages.pop(seq - 1)
+        self.fake.vanished[self.mailbox].append((msg.uid, self.fake.next_modseq(self.mailbox)))
+        if silent:
+          continue
+        if "QRESYNC" in self.enabled:
+          self.send(b"* VANISHED %d" % msg.uid)
+        else:
+          self.send(b"* %d EXPUNGE" % seq)
+      else:
+        seq += 1
+
+  def cmd_EXPUNGE(self, tag, args, uid):
+    self.require_selected()
+    self.expunge()
+
+  def cmd_CLOSE(self, tag, args, uid):
+    self.require_selected()
+    self.expunge(silent=True)
+    self.mailbox = None
+
+  def match(self, msg: FakeMessage, keys: list) -> bool:
+    """Evaluate a subset of SEARCH keys, all keys are ANDed"""
+    i = 0
+    while i < len(keys):
+      key = keys[i]
+      if isinstance(key, list):
+        if not self.match(msg, key):
+          return False
+        i += 1
+        continue
+      key = key.upper()
+      i += 1
+      if key == "ALL":
+        continue
+      if key in FLAG_KEYS:
+        if FLAG_KEYS[key] not in msg.flags:
+          return False
+        continue
+      if key.startswith("UN") and key[2:] in FLAG_KEYS:
+        if FLAG_KEYS[key[2:]] in msg.flags:
+          return False
+        continue
+      if key == "NOT":
+        if self.match(msg, [keys[i]]):
+          return False
+        i += 1
+        continue
+      if key == "OR":
+        if not (self.match(msg, [keys[i]]) or self.match(msg, [keys[i+1]])):
+          return False
+        i += 2
+        continue
+      value = keys[i]
+      i += 1
+      if key in ("FROM", "TO", "SUBJECT"):
+        fields = header_fields(msg.header, [key]).decode(errors="replace").lower()
+        if value.lower() not in fields:
+          return False
+      elif key == "TEXT" or key == "BODY":
+        if value.lower().encode() not in msg.raw.lower():
+          return False
+      elif key in ("BEFORE", "SINCE", "ON"):
+        d = datetime.strptime(value, IMAP_DATE_FMT).date()
+        md = msg.internaldate.date()
+        if (key == "BEFORE" and not md < d) or (key == "SINCE" and not md >= d) or (key == "ON" and md != d):
+          return False
+      elif key in ("SENTBEFORE", "SENTSINCE", "SENTON"):
+        d = datetime.strptime(value, IMAP_DATE_FMT).date()
+        sent = email.message_from_bytes(msg.header)["Date"]
+        if not sent:
+          return False
+        md = parsedate_to_datetime(sent).date()
+        if (key == "SENTBEFORE" and not md < d) or (key == "SENTSINCE" and not md >= d) or (key == "SENTON" and md != d):
+          return False
+      elif key == "LARGER":
+        if not msg.size > int(value):
+          return False
+      elif key == "SMALLER":
+        if not msg.size < int(value):
+          return False
+      elif key == "UID":
+        maximum = self.messages[-1].uid if self.messages else 0
+        if msg.uid not in parse_seqset(value, maximum):
+          return False
+      else:
+        raise ImapError("unsupported search key %s" % key)
+    return True
+
+  def cmd_SEARCH(self, tag, args, uid):
+    self.require_selected()
+    esearch = False
+    if args and args[0].upper() == "RETURN" and "ESEARCH" in self.fake.capabilities:
+      esearch = True
+      args = args[2:]
+    if args and args[0].upper() == "CHARSET":
+      args = args[2:]
+    hits = [msg.uid if uid else seq for seq, msg in enumerate(self.messages, 1) if self.match(msg, args)]
+    if not esearch:
+      self.send(b"* SEARCH" + b"".join(b" %d" % h for h in hits))
+      return
+    line = '* ESEARCH (TAG "%s")%s' % (tag, " UID" if uid else "")
+    if hits:
+      line += " ALL " + format_seqset(hits)
+    self.send(line.encode())
+
+
+#
+# POP3
+#
+
+class Pop3Handler(_Handler):
+
+  def send(self, line: bytes):
+    self.write(line + CRLF)
+
+  def send_multiline(self, first: bytes, data: bytes):
+    lines = data.split(CRLF)
+    if lines and lines[-1] == b"":
+      lines.pop()
+    out = [first] + [b"." + l if l.startswith(b".") else l for l in lines] + [b"."]
+    self.write(CRLF.join(out) + CRLF)
+
+  def serve(self):
+    self.deleted = set()
+    self.send(b"+OK fake POP3 server ready")
+    while True:
+      line = self.readline()
+      if not line:
+        return
+      args = line.decode().split()
+      if not args:
+        continue
+      command = args[0].upper()
+      self.fake.record(command)
+      handler = getattr(self, "cmd_" + command, None)
+      if handler is None:
+        self.send(b"-ERR unknown command")
+        continue
+      with self.fake.lock:
+        try:
+          handler(args[1:])
+        except (IndexError, ValueError) as e:
+          self.send(b"-ERR " + str(e).encode())
+      if command == "QUIT":
+        return
+
+  @property
+  def messages(self) -> List[FakeMessage]:
+    return self.fake.mailboxes["INBOX"]
+
+  def get(self, msg_id: str) -> FakeMessage:
+    i = int(msg_id)
+    if i in self.deleted or not 1 <= i <= len(self.messages):
+      raise ValueError("no such message")
+    return self.messages[i - 1]
+
+  def alive(self):
+    return [(i, m) for i, m in enumerate(self.messages, 1) if i not in self.deleted]
+
+  def cmd_USER(self, args):
+    self.send(b"+OK")
+
+  def cmd_PASS(self, args):
+    self.send(b"+OK logged in")
+
+  def cmd_NOOP(self, args):
+    self.send(b"+OK")
+
+  def cmd_STAT(self, args):
+    alive = self.alive()
+    self.send(b"+OK %d %d" % (len(alive), sum(m.size for _, m in alive)))
+
+  def cmd_LIST(self, args):
+    if args:
+      self.send(b"+OK %s %d" % (args[0].encode(), self.get(args[0]).size))
+      return
+    data = b"".join(b"%d %d\r\n" % (i, m.size) for i, m in self.alive())
+    self.send_multiline(b"+OK", data)
+
+  def cmd_UIDL(self, args):
+    if args:
+      self.send(b"+OK %s %d" % (args[0].encode(), self.get(args[0]).uid))
+      return
+    data = b"".join(b"%d %d\r\n" % (i, m.uid) for i, m in self.alive())
+    self.send_multiline(b"+OK", data)
+
+  def cmd_TOP(self, args):
+    msg = self.get(args[0])
+    n = int(args[1])
+    body = msg.raw[len(msg.header):]
+    lines = body.split(CRLF)[:n]
+    data = msg.header + CRLF.join(lines) + (CRLF if lines else b"")
+    self.send_multiline(b"+OK", data)
+
+  def cmd_RETR(self, args):
+    msg = self.get(args[0])
+    self.send_multiline(b"+OK %d octets" % msg.size, msg.raw)
+
+  def cmd_DELE(self, args):
+    self.get(args[0])
+    self.deleted.add(int(args[0]))
+    self.send(b"+OK deleted")
+
+  def cmd_RSET(self, args):
+    self.deleted = set()
+    self.send(b"+OK")
+
+  def cmd_QUIT(self, args):
+    for i in sorted(self.deleted, reverse=True):
+      del self.messages[i - 1]
+    self.deleted = set()
+    self.send(b"+OK bye")
@@ -1,10 +1,11 @@
 """
 Holiday
 """
-from typing import Dict, Tuple, Generator
+from typing import Dict, Tuple, Generator, Callable
 from datetime import date, datetime, timezone, time,timedelta, tzinfo
 from abc import ABC, abstractmethod, abstractproperty
 from functools import cached_property
+from time import sleep
 from urllib import request
 import json
 import logging
@@ -107,7 +108,7 @@ class HolidayBook(ABC):
     elif isinstance(dt, date):
       dt = datetime(dt.year, dt.month, dt.day, tzinfo=self.timezone)
     if dt is None:
-      dt = datetime.now().astimezone()
+      dt = datetime.now(self.timezone)
     return dt
 
   def ensure_year(self, year):
@@ -128,6 +129,16 @@ class HolidayBook(ABC):
       if not self.is_holiday(dt):
         return dt.date()
 
+  def next_workhour(self, dt: date|datetime=None) -> datetime:
+    """Get the start of next work hours, or the given datetime itself if it is within work hours"""
+    dt = self.normalize_date(dt)
+    if self.is_workhour(dt):
+      return dt
+    start = datetime.combine(dt.date(), self.workhours_start, tzinfo=self.timezone)
+    if dt < start and not self.is_holiday(dt):
+      return start
+    return datetime.combine(self.next_workday(dt), self.workhours_start, tzinfo=self.timezone)
+
   def latest_workday(self, dt: date|datetime=None) -> datetime:
     """Get latest workday"""
     dt = self.normalize_date(dt)
@@ -219,6 +230,26 @@ class NagerDateHolidayBook(HolidayBook):
         yield date.fromisoformat(item["date"]), True, item["name"]
 
 
+def run_periodically(job: Callable[[], None], interval: float, holiday_book: HolidayBook=None):
+  """Run job every interval seconds, but only during work hours of the holiday book
+
+  Outside work hours it sleeps until the start of next work hours and runs the job right away
+  after waking up, so the job could catch up with whatever happened in between.
+
+  :param job: the job to be run
+  :param interval: seconds to sleep between runs within work hours
+  :param holiday_book: run job regardless of work hours if not given
+  """
+  while True:
+    if holiday_book is None or holiday_book.is_workhour():
+      job()
+      sleep(interval)
+      continue
+    now = holiday_book.normalize_date(None)
+    start = holiday_book.next_workhour(now)
+    logger.info("out of work hours, sleeping until %s", start)
+    sleep(max((start - now).total_seconds(), 0))
+
 
 if __name__ == "__main__":
   logging.basicConfig(format='[%(asctime)s] %(name)s: %(message)s', level=logging.INFO)
@@ -244,4 +275,6 @@ if __name__ == "__main__":
   print("latest workday of", cnd, "is", cn_holiday_book.latest_workday(cnd))
   cnd = date(2023, 4, 5)
   print("latest workday of", cnd, "is", cn_holiday_book.latest_workday(cnd))
-  print("next workday of", cnd, "is", cn_holiday_book.next_workday(cnd))
\ No newline at end of file
+  print("next workday of", cnd, "is", cn_holiday_book.next_workday(cnd))
+  cnd = datetime(2023, 4, 5, 19, 0, 0, 0, cn_holiday_book.timezone)
+  print("next workhour of", cnd, "is", cn_holiday_book.next_workhour(cnd))
\ No newline at end of file
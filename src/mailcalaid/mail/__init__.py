@@ -1,5 +1,6 @@
-from .mailclient import Message, MailClient
+from .mailclient import Message, MessageMeta, MailClient
 from .pop3client import Pop3Client
 from .imapclient import ImapClient
+from .metrics import Metrics
 
-__all__ = ['Message', 'MailClient', 'Pop3Client', 'ImapClient']
\ No newline at end of file
+__all__ = ['Message', 'MessageMeta', 'MailClient', 'Pop3Client', 'ImapClient', 'Metrics']
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+Backup
+
+Incremental backups which only transfer messages not archived yet. A persistent index of archived
+unique ids, Message-IDs and content hashes is kept next to the archive as json lines.
+
+.. code-block:: python
+
+  client = ImapClient(host, port, user, password)
+  added, skipped = incremental_backup(client, "backup.mbox")
+"""
+from typing import Tuple
+import hashlib
+import json
+import logging
+import os
+from mailcalaid.mail.mailclient import MailClient
+from mailcalaid.mail.sinks import guess_format, open_sink
+
+logger = logging.getLogger(__name__)
+
+
+class BackupIndex:
+  """Index of archived messages
+
+  :param str path: index file path, created if not exists
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self.uids = set()
+    self.message_ids = set()
+    self.digests = set()
+    self.pending = []
+    if os.path.exists(path):
+      self.load()
+
+  def load(self):
+    """Load index from file"""
+    with open(self.path, "r", encoding="utf8") as f:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          self._add(entry.get("uid"), entry.get("message_id"), entry.get("sha256"))
+
+  def _add(self, uid: str, message_id: str, digest: str):
+    if uid:
+      self.uids.add(uid)
+    if message_id:
+      self.message_ids.add(message_id)
+    if digest:
+      self.digests.add(digest)
+
+  def contains(self, uid: str = "", message_id: str = "", digest: str = "") -> bool:
+    """Check if a message has been archived by any of its keys"""
+    return bool(
+      (uid and uid in self.uids) or
+      (message_id and message_id in self.message_ids) or
+      (digest and digest in self.digests)
+    )
+
+  def add(self, uid: str, message_id: str, digest: str):
+    """Add an archived message, it is persisted on next `save`"""
+    self._add(uid, message_id, digest)
+    self.pending.append({"uid": uid, "message_id": message_id, "sha256": digest})
+
+  def save(self):
+    """Append pending entries to the index file"""
+    with open(self.path, "a", encoding="utf8") as f:
+      for entry in self.pending:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    self.pending.clear()
+
+
+def incremental_backup(client: MailClient, path: str, index_path: str = "", format: str = "") -> Tuple[int, int]:
+  """Append messages not archived yet to archive
+
+  Header metadata of all messages is checked against the index first, only bodies of new messages
+  are fetched. Archive is flushed before the index every batch_size messages, an interruption
+  leads to duplicates in the archive at worst, never to missing messages.
+
+  :param client: mail client
+  :param str path: archive path, see `open_sink`
+  :param str index_path: index file, default to `path` (without trailing slash) + ".index"
+  :param str format: archive format, guessed by path if empty, compressed tarballs are not
+    supported as they could neither be appended to nor be flushed readable
+  :return: number of messages added and skipped
+  """
+  format = format or guess_format(path)
+  if format.startswith("tar."):
+    raise Exception("incremental backup could not append to compressed tarball %s, use tar, mbox.gz/xz/zst or maildir instead" % path)
+  # next to a Maildir rather than inside it, where other Maildir tools would trip over it
+  index = BackupIndex(index_path or path.rstrip("/" + os.sep) + ".index")
+  uids = {}
+  skipped = 0
+  for msg_id, uid, message_id in client.list_message_keys():
+    if index.contains(uid=uid, message_id=message_id):
+      skipped += 1
+    else:
+      uids[msg_id] = uid
+  logger.info("%d messages to be archived, %d archived already", len(uids), skipped)
+  if not uids:
+    return 0, skipped
+
+  archive = open_sink(path, format)
+  added = 0
+
+  def commit():
+    archive.flush()
+    index.save()
+
+  try:
+    for msg in client.fetch_messages(list(uids.keys()), None):
+      digest = hashlib.sha256(msg.msg).hexdigest()
+      if index.contains(message_id=msg.message_id, digest=digest):
+        # record the unique id of the duplicate too, it would be fetched again on every run otherwise
+        index.add(uids[msg.msg_id], msg.message_id, digest)
+        skipped += 1
+        continue
+      archive.add(msg)
+      index.add(uids[msg.msg_id], msg.message_id, digest)
+      added += 1
+      if added % client.batch_size == 0:
+        commit()
+  finally:
+    commit()
+    archive.close()
+  return added, skipped
@@ -1,37 +1,342 @@
 import logging
 import imaplib
 import re
-from datetime import datetime
-from typing import Generator, Union, List
-from mailcalaid.mail.mailclient import MailClient, Message
+import zlib
+import email
+import email.utils
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta
+from typing import Generator, Union, List, Tuple, Dict, Optional, Iterable
+from mailcalaid.mail.mailclient import MailClient, Message, MessageMeta, decode_header
+from mailcalaid.mail.metrics import instrument_imap
 
 logger = logging.getLogger(__name__)
 
 # Ref https://www.rfc-editor.org/rfc/rfc3501#section-6.4.5
 
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+
+
+class DeflateSocket:
+  """Socket wrapper compressing outgoing data with raw deflate, see RFC 4978"""
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    self.raw_bytes_out = 0
+
+  def sendall(self, data: bytes):
+    data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self.raw_bytes_out += len(data)
+    self.sock.sendall(data)
+
+  def __getattr__(self, name):
+    return getattr(self.sock, name)
+
+
+class DeflateReader:
+  """Buffered reader wrapper decompressing incoming raw deflate stream, see RFC 4978"""
+
+  def __init__(self, file):
+    self.file = file
+    self.decompressor = zlib.decompressobj(-15)
+    self.buffer = bytearray()
+    self.raw_bytes_in = 0
+
+  def _fill(self) -> bool:
+    data = self.file.read1(65536)
+    if not data:
+      return False
+    self.raw_bytes_in += len(data)
+    self.buffer += self.decompressor.decompress(data)
+    return True
+
+  def _take(self, size: int) -> bytes:
+    data = bytes(self.buffer[:size])
+    del self.buffer[:size]
+    return data
+
+  def read(self, size: int) -> bytes:
+    while len(self.buffer) < size and self._fill():
+      pass
+    return self._take(size)
+
+  def readline(self, limit: int = -1) -> bytes:
+    start = 0
+    while True:
+      idx = self.buffer.find(b"\n", start)
+      if idx >= 0:
+        size = idx + 1
+        break
+      start = len(self.buffer)
+      if 0 <= limit <= start or not self._fill():
+        size = start
+        break
+    if limit >= 0:
+      size = min(size, limit)
+    return self._take(size)
+
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+
+STATUS_RE = re.compile(rb'(?P<name>.*) \((?P<items>[^()]*)\)$')
+FETCH_UID_RE = re.compile(rb'(?P<msg_id>\d+) \(.*?UID (?P<uid>\d+)')
+FETCH_UID_ITEM_RE = re.compile(rb'[( ]UID (\d+)')
+FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_INTERNALDATE_RE = re.compile(rb'INTERNALDATE "([^"]+)"')
+FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+FETCH_MODSEQ_RE = re.compile(rb'MODSEQ \((\d+)\)')
+FETCH_MSG_ID_RE = re.compile(rb'(\d+) ')
+ESEARCH_ALL_RE = re.compile(rb' ALL (\S+)')
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+SEARCH_FLAGS = ("seen", "unseen", "flagged", "unflagged", "answered", "unanswered", "deleted", "undeleted", "draft", "undraft")
+
+
+def imap_date(d: date) -> str:
+  """Format date as IMAP date, e.g. 1-Mar-2023, regardless of locale"""
+  return "%d-%s-%d" % (d.day, MONTHS[d.month - 1], d.year)
+
+
+def search_value(value: str, literal_plus: bool = True) -> bytes:
+  """Quote a SEARCH value, non-ascii ones are sent as non-synchronizing literals if the server
+  supports LITERAL+, as quoted utf-8 otherwise which most servers accept"""
+  data = value.encode("utf-8")
+  if literal_plus and not data.isascii():
+    return b"{%d+}\r\n" % len(data) + data
+  return b'"' + data.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+
+def search_criteria(
+  sender: str = "",
+  subject: str = "",
+  since: date = None,
+  before: date = None,
+  larger: int = 0,
+  smaller: int = 0,
+  flags: Iterable[str] = (),
+  text: Iterable[str] = (),
+  literal_plus: bool = True,
+) -> bytes:
+  """Compile conditions into IMAP SEARCH criteria, conditions are ANDed
+
+  :param str sender: substring of From
+  :param str subject: substring of Subject
+  :param date since: internal date on or after
+  :param date before: internal date before
+  :param int larger: size larger than, in bytes
+  :param int smaller: size smaller than, in bytes
+  :param flags: any of `SEARCH_FLAGS`
+  :param text: words, each appears in header or body
+  :param bool literal_plus: server supports LITERAL+
+  """
+  criteria = []
+  if sender:
+    criteria.append(b"FROM " + search_value(sender, literal_plus))
+  if subject:
+    criteria.append(b"SUBJECT " + search_value(subject, literal_plus))
+  for key, d in ((b"SINCE", since), (b"BEFORE", before)):
+    if d:
+      criteria.append(key + b" " + imap_date(d).encode())
+  if larger:
+    criteria.append(b"LARGER %d" % larger)
+  if smaller:
+    criteria.append(b"SMALLER %d" % smaller)
+  for flag in flags:
+    if flag.lower() not in SEARCH_FLAGS:
+      raise Exception("unsupported search flag %s" % flag)
+    criteria.append(flag.upper().encode())
+  for word in text:
+    criteria.append(b"TEXT " + search_value(word, literal_plus))
+  return b" ".join(criteria) or b"ALL"
+
+
+def fetch_literals(resp: list) -> Generator[Tuple[int, bytes, bytes], None, None]:
+  """Split a FETCH response of one literal per message into message id, the other fetch items
+  and the literal
+
+  Servers may return fetch items in any order, imaplib hands those after the literal over as
+  the next element of the response
+  """
+  for i, item in enumerate(resp):
+    if not isinstance(item, tuple):
+      continue
+    trailing = resp[i + 1] if i + 1 < len(resp) and isinstance(resp[i + 1], bytes) else b""
+    yield int(item[0].split(b" ", 1)[0]), item[0] + b" " + trailing, item[1]
+
+
+def fetch_item(pattern: re.Pattern, items: bytes, name: str) -> str:
+  """Value of a fetch item found by pattern, see `fetch_literals`"""
+  m = pattern.search(items)
+  if not m:
+    raise Exception("%s missing in FETCH response %s" % (name, items.decode(errors="replace")))
+  return m.group(1).decode()
+
+
+def parse_uid_set(uid_set: bytes) -> List[int]:
+  """Expand uid set like 1:3,7 into a list of uids"""
+  uids = []
+  for part in uid_set.split(b","):
+    first, _, last = part.partition(b":")
+    first, last = int(first), int(last or first)
+    if first > last:
+      first, last = last, first
+    uids.extend(range(first, last + 1))
+  return uids
+
+
+@dataclass
+class MailboxChanges:
+  """Changes of a mailbox since a previous state, see `ImapClient.resync`
+
+  :param str uidvalidity: current UIDVALIDITY
+  :param int highestmodseq: current HIGHESTMODSEQ, to be kept for the next resync
+  :param dict flags: uid to flags of messages changed or added
+  :param list vanished: uids of messages expunged, None if unknown (CONDSTORE only)
+  :param bool reset: UIDVALIDITY changed or no mod-sequence was known, uids known before are
+    meaningless and the mailbox has to be scanned again
+  """
+  uidvalidity: str
+  highestmodseq: int
+  flags: Dict[int, Tuple[str, ...]]
+  vanished: Optional[List[int]]
+  reset: bool = False
+
+
 class ImapClient(MailClient):
   MSG_HEADER = '(BODY.PEEK[HEADER])'
   MSG_FULL = '(RFC822)'
+  MSG_KEYS = '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+  MSG_META = '(RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM)])'
   client: imaplib.IMAP4
   mailbox: str = "INBOX"
+  exists: int = 0
+  uidnext: int = 0
+  uidvalidity: str = ""
+  highestmodseq: int = 0
+  compress: bool = True
+  condstore: bool = True
+  enabled: Tuple[str, ...] = ()
 
   def open(self):
     if self.ssl:
       self.client = imaplib.IMAP4_SSL(host=self.host, port=self.port)
     else:
       self.client = imaplib.IMAP4(host=self.host, port=self.port)
+    if self.metrics:
+      instrument_imap(self.client, self.metrics)
+    self.track_size_changes()
     self.client.socket().settimeout(self.timeout)
     code, resp = self.client.login(self.user, self.password)
     if code != 'OK':
       raise Exception(resp[0].decode())
+    self.refresh_capabilities()
+    if self.compress:
+      self.enable_compression()
+    if self.condstore:
+      self.enable_condstore()
     self.select(self.mailbox)
 
   def close(self):
+    if isinstance(self.client.file, DeflateReader):
+      logger.debug(
+        "compression: received %d bytes on wire, sent %d bytes on wire",
+        self.client.file.raw_bytes_in, self.client.sock.raw_bytes_out,
+      )
     self.client.close()
 
+  def track_size_changes(self):
+    """Record EXISTS, EXPUNGE and VANISHED responses in arrival order
+
+    imaplib groups untagged responses by type, which loses whether new mail (EXISTS) was reported
+    before or after an expunge, while the message count depends on it
+    """
+    self.size_changes: List[Tuple[str, bytes]] = []
+    append_untagged = self.client._append_untagged
+
+    def _append_untagged(typ, dat):
+      if typ in ('EXISTS', 'EXPUNGE', 'VANISHED'):
+        self.size_changes.append((typ, dat))
+      append_untagged(typ, dat)
+
+    self.client._append_untagged = _append_untagged
+
+  def refresh_capabilities(self) -> tuple:
+    """Refresh capabilities after authentication, servers may advertise more of them afterward"""
+    code, resp = self.client.response('CAPABILITY')
+    if resp[-1] is None:
+      code, resp = self.client.capability()
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+    self.client.capabilities = tuple(resp[-1].decode().upper().split())
+    return self.client.capabilities
+
+  def enable_compression(self) -> bool:
+    """Enable COMPRESS=DEFLATE (RFC 4978) if the server supports it
+
+    All traffic afterward is compressed transparently
+    """
+    if 'COMPRESS=DEFLATE' not in self.client.capabilities:
+      return False
+    code, resp = self.client._simple_command('COMPRESS', 'DEFLATE')
+    if code != 'OK':
+      logger.warning("failed to enable compression: %s", resp[0].decode())
+      return False
+    self.client.sock = DeflateSocket(self.client.sock)
+    self.client.file = DeflateReader(self.client.file)
+    logger.debug("compression enabled")
+    return True
+
+  def enable_condstore(self) -> Tuple[str, ...]:
+    """Enable QRESYNC or CONDSTORE (RFC 7162) if the server supports them, see `resync`
+
+    :return: extensions enabled
+    """
+    capabilities = self.client.capabilities
+    extensions = [ext for ext in ('QRESYNC', 'CONDSTORE') if ext in capabilities]
+    if not extensions or 'ENABLE' not in capabilities:
+      return ()
+    code, resp = self.client._simple_command('ENABLE', *extensions)
+    if code != 'OK':
+      logger.warning("failed to enable %s: %s", extensions, resp[0].decode())
+      return ()
+    code, resp = self.client.response('ENABLED')
+    self.enabled = tuple(b" ".join(r for r in resp if r).decode().upper().split())
+    logger.debug("enabled %s", self.enabled)
+    return self.enabled
+
   @property
   def total_messages(self) -> int:
-    return self.select(self.mailbox)
+    self.update_state()
+    return self.exists
+
+  def update_state(self):
+    """Update state of the selected mailbox from untagged responses received so far, no round trip involved"""
+    responses = self.client.untagged_responses
+    for typ, dat in self.size_changes:
+      if typ == 'EXISTS':
+        self.exists = int(dat)
+      elif typ == 'EXPUNGE':
+        self.exists -= 1
+      # expunges are reported as VANISHED instead of EXPUNGE once QRESYNC is enabled
+      elif not dat.startswith(b"(EARLIER)"):
+        self.exists -= len(parse_uid_set(dat))
+    self.size_changes.clear()
+    for typ in ('EXISTS', 'EXPUNGE', 'VANISHED'):
+      responses.pop(typ, None)
+    uidnext = responses.pop('UIDNEXT', None)
+    if uidnext:
+      self.uidnext = int(uidnext[-1])
+    uidvalidity = responses.pop('UIDVALIDITY', None)
+    if uidvalidity:
+      self.uidvalidity = uidvalidity[-1].decode()
+    highestmodseq = responses.pop('HIGHESTMODSEQ', None)
+    if highestmodseq:
+      self.highestmodseq = int(highestmodseq[-1])
+    if responses.pop('NOMODSEQ', None):
+      self.highestmodseq = 0
 
   def list_mailboxes(self) -> Generator[dict, None, None]:
     """List mailboxes in the current account"""
@@ -47,11 +352,122 @@ class ImapClient(MailClient):
 
   def select(self, mailbox: str) -> int:
     """Select a mailbox and return the number of messages in it"""
+    # changes of the previously selected mailbox, imaplib flushes their untagged responses as well
+    self.size_changes.clear()
     code, resp = self.client.select('"%s"' % mailbox)
     if code != 'OK':
       raise Exception(resp[0].decode())
     self.mailbox = mailbox
-    return int(resp[0].decode())
+    self.exists = int(resp[0].decode())
+    self.highestmodseq = 0
+    self.update_state()
+    return self.exists
+
+  def resync(self, uidvalidity: str, highestmodseq: int) -> MailboxChanges:
+    """Changes of the selected mailbox since a state (uidvalidity, highestmodseq) kept from a
+    previous session, without scanning the mailbox
+
+    With QRESYNC the mailbox is reselected with the known state, the server reports changed flags
+    and expunged uids within the SELECT, a single round trip. With CONDSTORE only, changed flags
+    are fetched by CHANGEDSINCE while expunged uids remain unknown.
+    """
+    client = self.client
+    if 'QRESYNC' not in self.enabled and 'CONDSTORE' not in client.capabilities:
+      raise Exception("server supports neither CONDSTORE nor QRESYNC")
+    if not highestmodseq:
+      # no mod-sequence kept, e.g. the mailbox had none, there is nothing to resync from
+      self.select(self.mailbox)
+      return MailboxChanges(self.uidvalidity, self.highestmodseq, {}, None, reset=True)
+    if 'QRESYNC' in self.enabled:
+      client.untagged_responses = {}
+      self.size_changes.clear()
+      code, resp = client._simple_command('SELECT', '"%s"' % self.mailbox, '(QRESYNC (%s %d))' % (uidvalidity, highestmodseq))
+      if code != 'OK':
+        client.state = 'AUTH'
+        raise Exception(resp[0].decode())
+      client.state = 'SELECTED'
+      vanished = client.untagged_responses.pop('VANISHED', [])
+      fetches = client.untagged_responses.pop('FETCH', [])
+      self.highestmodseq = 0
+      self.update_state()
+    else:
+      # HIGHESTMODSEQ is only reported on SELECT, reselect before fetching changes so that
+      # changes made in between are fetched again next time rather than missed
+      self.select(self.mailbox)
+      if not self.highestmodseq:
+        return MailboxChanges(self.uidvalidity, self.highestmodseq, {}, None, reset=True)
+      vanished = None
+      fetches = []
+      if self.uidvalidity == uidvalidity:
+        code, fetches = client.uid('FETCH', '1:*', '(UID FLAGS)', '(CHANGEDSINCE %d)' % highestmodseq)
+        if code != 'OK':
+          raise Exception(fetches[0].decode())
+    if self.uidvalidity != uidvalidity:
+      return MailboxChanges(self.uidvalidity, self.highestmodseq, {}, None, reset=True)
+    flags = {}
+    for line in fetches:
+      if isinstance(line, tuple):
+        line = line[0]
+      if not line:
+        continue
+      m = FETCH_UID_RE.match(line)
+      f = FETCH_FLAGS_RE.search(line)
+      if m and f:
+        flags[int(m.group("uid"))] = tuple(f.group(1).decode().split())
+      modseq = FETCH_MODSEQ_RE.search(line)
+      if modseq:
+        self.highestmodseq = max(self.highestmodseq, int(modseq.group(1)))
+    if vanished is not None:
+      vanished = [
+        uid for line in vanished
+        for uid in parse_uid_set(line[len(b"(EARLIER) "):] if line.startswith(b"(EARLIER) ") else line)
+      ]
+    return MailboxChanges(self.uidvalidity, self.highestmodseq, flags, vanished)
+
+  def list_mailbox_status(self) -> Generator[dict, None, None]:
+    """List message, unseen and size (if server supports STATUS=SIZE) counts of all mailboxes
+
+    A single LIST-STATUS (RFC 5819) command if the server supports it, otherwise a LIST followed
+    by pipelined STATUS commands, i.e. two round trips regardless of the number of mailboxes
+    """
+    capabilities = self.client.capabilities
+    items = "MESSAGES UNSEEN" + (" SIZE" if "STATUS=SIZE" in capabilities else "")
+    if "LIST-STATUS" in capabilities:
+      code, resp = self.client._simple_command('LIST', '""', '*', 'RETURN (STATUS (%s))' % items)
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+      self.client.response('LIST')
+    else:
+      names = [
+        mailbox["name"] for mailbox in self.list_mailboxes()
+        if "\\noselect" not in mailbox["flags"].lower()
+      ]
+      tags = [self.client._command('STATUS', name, '(%s)' % items) for name in names]
+      for tag in tags:
+        code, resp = self.client._command_complete('STATUS', tag)
+        if code != 'OK':
+          logger.warning("failed to get status: %s", resp[0].decode())
+    code, statuses = self.client.response('STATUS')
+    name = None
+    for line in statuses:
+      if line is None:
+        continue
+      if isinstance(line, tuple):
+        # mailbox name sent as literal, items follow in the next line
+        name = line[1]
+        continue
+      m = STATUS_RE.match(line)
+      values = m.group("items").decode().split()
+      status = {k.lower(): int(v) for k, v in zip(values[::2], values[1::2])}
+      if name is None:
+        name = m.group("name")
+      yield {
+        "name": name.decode().strip('"'),
+        "messages": status.get("messages"),
+        "unseen": status.get("unseen"),
+        "size": status.get("size"),
+      }
+      name = None
   
   def _fetch_message(self, msg_id:int, headeronly: bool) -> bytes:
     message_parts = self.MSG_HEADER if headeronly else self.MSG_FULL
@@ -61,12 +477,121 @@ class ImapClient(MailClient):
     logger.debug("fetch messags %s, response length: %d", msg_id, len(resp)) 
     return resp[0][1]
 
-  def search(self, criterion: str):
-    """Search messages in the current mailbox"""
-    code, resp = self.client.search(None, criterion)
+  def list_message_keys(self) -> Generator[Tuple[int, str, str], None, None]:
+    """List message id, unique id and Message-ID header of all messages in mailbox
+
+    Fetched in bulk, one command per batch_size messages. Unique id consists of mailbox name,
+    UIDVALIDITY and UID
+    """
+    total = self.total_messages
+    for start in range(1, total + 1, self.batch_size):
+      end = min(start + self.batch_size - 1, total)
+      code, resp = self.client.fetch("%d:%d" % (start, end), self.MSG_KEYS)
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+      keys = []
+      for msg_id, items, header in fetch_literals(resp):
+        message_id = email.message_from_bytes(header)["Message-ID"] or ""
+        uid = "%s:%s:%s" % (self.mailbox, self.uidvalidity, fetch_item(FETCH_UID_ITEM_RE, items, "UID"))
+        keys.append((msg_id, uid, message_id.strip()))
+      yield from keys
+
+  def list_metadata(self) -> Generator[MessageMeta, None, None]:
+    """List size, internal date and sender of all messages in mailbox
+
+    Fetched in bulk without message bodies, one command per batch_size messages
+    """
+    total = self.total_messages
+    for start in range(1, total + 1, self.batch_size):
+      end = min(start + self.batch_size - 1, total)
+      code, resp = self.client.fetch("%d:%d" % (start, end), self.MSG_META)
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+      metas = []
+      for msg_id, items, header in fetch_literals(resp):
+        size = int(fetch_item(FETCH_SIZE_RE, items, "RFC822.SIZE"))
+        date = datetime.strptime(fetch_item(FETCH_INTERNALDATE_RE, items, "INTERNALDATE").strip(), "%d-%b-%Y %H:%M:%S %z")
+        sender = email.utils.parseaddr(decode_header(email.message_from_bytes(header)["From"]))[1]
+        metas.append(MessageMeta(msg_id, size, date, sender))
+      yield from metas
+
+  def search(self, criterion: Union[str, bytes], charset: str = None):
+    """Search messages in the current mailbox
+
+    Results come back as a compact sequence set by ESEARCH (RFC 4731) if the server supports it
+
+    :param criterion: SEARCH criteria, see `search_criteria`
+    :param str charset: charset of criteria, e.g. UTF-8 when it contains non-ascii values
+    :return: message ids, None if nothing matched
+    """
+    if 'ESEARCH' not in self.client.capabilities:
+      code, resp = self.client.search(charset, criterion)
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+      return resp[0].decode().split() if resp[0] else None
+    args = ('CHARSET', charset) if charset else ()
+    code, resp = self.client._simple_command('SEARCH', 'RETURN (ALL)', *args, criterion)
     if code != 'OK':
       raise Exception(resp[0].decode())
-    return resp[0].decode().split() if resp[0] else None
+    code, resp = self.client._untagged_response(code, resp, 'ESEARCH')
+    m = ESEARCH_ALL_RE.search(resp[-1] or b"")
+    if not m:
+      return None
+    return [str(msg_id) for msg_id in parse_uid_set(m.group(1))]
+
+  def fetch_messages_after(self, dt: datetime, headeronly=True) -> Generator[Message, None, None]:
+    """Fetch messages after date, newest first
+
+    Candidates are searched by SENTSINCE on the server, widened by a day as it ignores time and
+    timezone, then checked by date one by one. Messages without a date are skipped.
+
+    :param datetime dt: date
+    :param bool headeronly: fetch only header
+    """
+    msg_ids = [int(i) for i in self.search("SENTSINCE " + imap_date(dt.date() - timedelta(days=1))) or ()]
+    for msg in self.fetch_messages(msg_ids[::-1], None, headeronly=headeronly):
+      if msg.date is None or msg.date < dt:
+        logger.debug("skip message %s date %s < %s", msg.msg_id, msg.date, dt)
+        continue
+      yield msg
+
+  def fetch_messages_before(self, dt: datetime, headeronly=True) -> Generator[Message, None, None]:
+    """Fetch messages before date, oldest first
+
+    Candidates are searched by SENTBEFORE on the server, widened by a day as it ignores time and
+    timezone, then checked by date one by one. Messages without a date are skipped.
+
+    :param datetime dt: date
+    :param bool headeronly: fetch only header
+    """
+    msg_ids = [int(i) for i in self.search("SENTBEFORE " + imap_date(dt.date() + timedelta(days=2))) or ()]
+    for msg in self.fetch_messages(msg_ids, None, headeronly=headeronly):
+      if msg.date is None or msg.date > dt:
+        logger.debug("skip message %s date %s > %s", msg.msg_id, msg.date, dt)
+        continue
+      yield msg
+
+  def fetch_messages(self,
+    msg_id: Union[int,  List[int]],
+    msg_id_end: int,
+    headeronly=False,
+  ) -> Generator[Message, None, None]:
+    """Fetch messages, headers of a list of messages are fetched in bulk, one command per batch_size messages"""
+    if not (headeronly and isinstance(msg_id, list)):
+      yield from super().fetch_messages(msg_id, msg_id_end, headeronly=headeronly)
+      return
+    for start in range(0, len(msg_id), self.batch_size):
+      batch = [int(i) for i in msg_id[start:start + self.batch_size]]
+      code, resp = self.client.fetch(",".join(map(str, batch)), self.MSG_HEADER)
+      if code != 'OK':
+        raise Exception(resp[0].decode())
+      headers = {}
+      for item in resp:
+        if isinstance(item, tuple):
+          headers[int(FETCH_MSG_ID_RE.match(item[0]).group(1))] = item[1]
+      for i in batch:
+        if i in headers:
+          yield Message(i, headers[i])
 
   def _mark_deleted(self, msg_id: int):
     code, resp = self.client.store(msg_id, "+FLAGS", "(\\Deleted)")
@@ -82,3 +607,5 @@ class ImapClient(MailClient):
     code, resp = self.client.expunge()
     if code != 'OK':
       raise Exception(resp[0].decode())
+    # expunges are counted by the size changes recorded, in the order they arrived
+    self.update_state()
@@ -64,6 +64,10 @@ class Message:
   def bcc(self):
     return decode_header(self.message["Bcc"])
 
+  @cached_property
+  def message_id(self) -> str:
+    return (self.message["Message-ID"] or "").strip()
+
   @cached_property
   def subject(self):
     return decode_header(self.message["Subject"]).replace("\r\n", "")
@@ -72,7 +76,7 @@ class Message:
   def date(self):
     d = self.message["Date"]
     if not d:
-      d = self.message["Received"].split(";")[1].strip()
+      d = (self.message["Received"] or "").rpartition(";")[2].strip()
     if not d:
       logger.warning("no date header found\n%s", self.msg)
       return None
@@ -86,6 +90,21 @@ class Message:
       return None
 
 
+@dataclass
+class MessageMeta:
+  """Metadata of a message, cheap to fetch without the message body
+
+  :param int msg_id: message id
+  :param int size: message size in bytes
+  :param datetime date: internal date (imap) or Date header (pop3), None if unknown
+  :param str sender: sender address, empty if unknown
+  """
+  msg_id: int
+  size: int
+  date: Optional[datetime]
+  sender: str
+
+
 def decode_header(header):
   # print("header", type(header), header)
   if not header:
@@ -113,9 +132,10 @@ class MailClient(ABC):
   :param bool ssl: use ssl when connecting to mail server
   :param int batch_size: batch size when processing messages
   :param bool dry_run: dry run mode
+  :param Metrics metrics: optional, collect per command metrics
   """
 
-  def __init__(self, host: str, port: int, user: str, password: str, ssl=True, batch_size=100, dry_run=False, timeout=60):
+  def __init__(self, host: str, port: int, user: str, password: str, ssl=True, batch_size=100, dry_run=False, timeout=60, metrics=None):
     self.host = host
     self.port = port
     self.user = user
@@ -124,6 +144,7 @@ class MailClient(ABC):
     self.batch_size = batch_size
     self.dry_run = dry_run
     self.timeout = timeout
+    self.metrics = metrics
     if self._fetch_message is None and self._fetch_messages is None:
       raise Exception("either _fetch_messages or _fetch_message must be implemented")
     self.open()
@@ -203,6 +224,9 @@ class MailClient(ABC):
     :param bool headeronly: fetch only header
     """
     for msg in self.fetch_messages(self.total_messages, 1, headeronly=headeronly):
+      if msg.date is None:
+        logger.debug("skip message %s without date", msg.msg_id)
+        continue
       if msg.date < dt:
         logger.debug("stop fetching because message %s date %s < %s", msg.msg_id, msg.date, dt)
         return
@@ -217,6 +241,9 @@ class MailClient(ABC):
     :param bool headeronly: fetch only header
     """
     for msg in self.fetch_messages(1, self.total_messages, headeronly=headeronly):
+      if msg.date is None:
+        logger.debug("skip message %s without date", msg.msg_id)
+        continue
       if msg.date > dt:
         logger.debug("stop fetching because message %s date %s > %s", msg.msg_id, msg.date, dt)
         return
@@ -224,6 +251,28 @@ class MailClient(ABC):
         logger.debug("message %s date %s", msg.msg_id, msg.date)
       yield msg
   
+  def list_message_keys(self) -> Generator[Tuple[int, str, str], None, None]:
+    """List message id, unique id and Message-ID header of all messages in mailbox
+
+    Unique id stays the same across sessions, it is empty if the protocol provides none
+    """
+    total = self.total_messages
+    if not total:
+      return
+    for msg in self.fetch_messages(1, total, headeronly=True):
+      yield msg.msg_id, "", msg.message_id
+
+  def list_metadata(self) -> Generator[MessageMeta, None, None]:
+    """List size, date and sender of all messages in mailbox
+
+    Subclasses fetch these without message bodies, this fallback downloads every message
+    """
+    total = self.total_messages
+    if not total:
+      return
+    for msg in self.fetch_messages(1, total):
+      yield MessageMeta(msg.msg_id, len(msg.msg), msg.date, msg.sender_addr[1])
+
   def mark_deleted_before(self, dt: datetime):
     """Mark messages before date as deleted """
     for msg in self.fetch_messages_before(dt):
@@ -0,0 +1,280 @@
+"""
+Mbox Index
+
+Offline full-text index over mbox archives, e.g. those downloaded by `mailaid download`. Terms of
+subject, sender and decoded text bodies are kept in an on-disk inverted index (sqlite) along with
+byte offsets of every message, so hits are read straight from the archive without rescanning it.
+
+.. code-block:: python
+
+  index = MboxIndex("backup.mbox")
+  index.update()  # incremental, only messages appended since last update are parsed
+  for hit in index.search("from:github devlake since:2023-03-01"):
+    print(hit.date, hit.sender, hit.subject)
+    print(index.open(hit).text)
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Generator, Tuple
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+from mailcalaid.mail.mailclient import Message
+
+logger = logging.getLogger(__name__)
+
+FIELDS = {"subject": 1, "from": 2, "body": 3}
+TERM_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W_]+")
+TAG_RE = re.compile(r"<[^>]+>")
+# body lines starting with From are written as >From, and >From as >>From by mboxrd writers
+ESCAPED_FROM_RE = re.compile(rb"^>(>*From )", re.M)
+# magic numbers of gzip, xz and zstd
+COMPRESSED_MAGIC = (b"\x1f\x8b", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd")
+MAX_TERM_LENGTH = 64
+HEAD_SIZE = 4096
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS messages (
+  id INTEGER PRIMARY KEY,
+  offset INTEGER NOT NULL,
+  length INTEGER NOT NULL,
+  date REAL,
+  sender TEXT,
+  subject TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE TABLE IF NOT EXISTS postings (
+  term TEXT NOT NULL,
+  field INTEGER NOT NULL,
+  msg INTEGER NOT NULL,
+  PRIMARY KEY (term, field, msg)
+) WITHOUT ROWID;
+"""
+
+
+def tokenize(text: str) -> List[str]:
+  """Split text into lowercase terms, CJK characters are indexed one by one"""
+  if not text:
+    return []
+  return [t for t in TERM_RE.findall(text.lower()) if len(t) <= MAX_TERM_LENGTH]
+
+
+@dataclass
+class Hit:
+  """A message matching a query"""
+  id: int
+  offset: int
+  length: int
+  date: datetime
+  sender: str
+  subject: str
+
+
+def unescape_from(raw: bytes) -> bytes:
+  """Revert the >From escaping of body lines in mbox"""
+  return ESCAPED_FROM_RE.sub(rb"\1", raw)
+
+
+def scan_mbox(path: str, offset: int = 0) -> Generator[Tuple[int, int, bytes], None, None]:
+  """Scan mbox file from offset, yield start and end byte offsets and raw bytes (without the From_ line) of messages
+
+  Raw bytes are as stored, see `unescape_from`
+  """
+  with open(path, "rb") as f:
+    f.seek(offset)
+    start = None
+    lines = []
+    pos = offset
+    for line in f:
+      if line.startswith(b"From "):
+        if start is not None:
+          yield start, pos, b"".join(lines)
+        start = pos
+        lines = []
+      elif start is not None:
+        lines.append(line)
+      pos += len(line)
+    if start is not None:
+      yield start, pos, b"".join(lines)
+
+
+def message_text(msg: Message) -> str:
+  """Decoded text body of message, html tags are stripped"""
+  try:
+    if msg.plain:
+      return msg.plain
+    return TAG_RE.sub(" ", msg.html or "")
+  except Exception as e:
+    logger.debug("failed to decode body of message at %s: %s", msg.msg_id, e)
+    payload = msg.message.get_payload(decode=True)
+    return payload.decode("utf-8", errors="replace") if isinstance(payload, bytes) else ""
+
+
+class MboxIndex:
+  """Inverted index of a mbox file
+
+  :param str path: mbox file
+  :param str index_path: index file, default to `path` + ".search.db"
+  """
+
+  def __init__(self, path: str, index_path: str = ""):
+    self.path = path
+    self.index_path = index_path or path + ".search.db"
+    self.db = sqlite3.connect(self.index_path)
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def _meta(self, key: str, default: str = "") -> str:
+    row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+  def _head_digest(self, size: int) -> str:
+    with open(self.path, "rb") as f:
+      return hashlib.sha256(f.read(size)).hexdigest()
+
+  def clear(self):
+    """Drop everything indexed"""
+    with self.db:
+      self.db.execute("DELETE FROM postings")
+      self.db.execute("DELETE FROM messages")
+      self.db.execute("DELETE FROM meta")
+
+  def _check_uncompressed(self):
+    with open(self.path, "rb") as f:
+      if f.read(6).startswith(COMPRESSED_MAGIC):
+        raise Exception("%s is compressed, messages are located by byte offsets, decompress it before indexing" % self.path)
+
+  def update(self, batch_size: int = 500) -> int:
+    """Index messages appended since last update, the whole archive is reindexed if it was rewritten
+
+    :return: number of messages indexed
+    """
+    self._check_uncompressed()
+    size = os.path.getsize(self.path)
+    offset = int(self._meta("offset", "0"))
+    head = self._meta("head")
+    # indexes of earlier versions kept no head of archives smaller than HEAD_SIZE
+    head_size = int(self._meta("head_size", str(HEAD_SIZE)))
+    if offset > size or (offset and (not head or head != self._head_digest(head_size))):
+      logger.info("%s has been rewritten, reindexing", self.path)
+      self.clear()
+      offset = 0
+    if offset == size:
+      return 0
+    count = 0
+    messages, postings = [], []
+
+    def commit(end: int):
+      with self.db:
+        self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", messages)
+        self.db.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?, ?)", postings)
+        # the first bytes indexed are hashed to detect a rewritten archive, however small it is
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", (
+          ("offset", str(end)),
+          ("head", self._head_digest(min(end, HEAD_SIZE))),
+          ("head_size", str(min(end, HEAD_SIZE))),
+        ))
+      messages.clear()
+      postings.clear()
+
+    next_id = self.db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+    for start, end, raw in scan_mbox(self.path, offset):
+      msg = Message(start, unescape_from(raw))
+      date = msg.date
+      messages.append((next_id, start, len(raw), date.timestamp() if date else None, msg.sender, msg.subject))
+      for field, text in (("subject", msg.subject), ("from", msg.sender), ("body", message_text(msg))):
+        for term in set(tokenize(text)):
+          postings.append((term, FIELDS[field], next_id))
+      next_id += 1
+      count += 1
+      if len(messages) >= batch_size:
+        commit(end)
+    if messages:
+      commit(size)
+    logger.info("indexed %d messages of %s", count, self.path)
+    return count
+
+  def _term_query(self, term: str, field: str = "") -> Tuple[str, list]:
+    sql, params = "SELECT msg FROM postings WHERE ", []
+    if term.endswith("*"):
+      prefix = term[:-1]
+      sql += "term >= ? AND term < ?"
+      params += [prefix, prefix + "\U0010ffff"]
+    else:
+      sql += "term = ?"
+      params.append(term)
+    if field:
+      sql += " AND field = ?"
+      params.append(FIELDS[field])
+    return sql, params
+
+  def search(self, query: str, limit: int = 50) -> List[Hit]:
+    """Search messages, newest first
+
+    Query consists of terms which are ANDed, a term could be
+    - a word, matches any of subject, sender and body
+    - field:word, field is one of subject, from and body
+    - word*, prefix match
+    - since:YYYY-MM-DD / until:YYYY-MM-DD, date range
+    """
+    subqueries, params = [], []
+    conditions, date_params = [], []
+    for token in query.split():
+      field, sep, value = token.partition(":")
+      field = field.lower()
+      if field in ("since", "until"):
+        try:
+          dt = datetime.fromisoformat(value)
+        except ValueError:
+          raise Exception("invalid date in %s: %s, expected YYYY-MM-DD" % (field, value))
+        conditions.append("date >= ?" if field == "since" else "date < ?")
+        date_params.append(dt.astimezone().timestamp())
+        continue
+      if not sep or field not in FIELDS:
+        field, value = "", token
+      terms = tokenize(value)
+      if terms and value.endswith("*"):
+        terms[-1] += "*"
+      for term in terms:
+        sql, p = self._term_query(term, field)
+        subqueries.append(sql)
+        params += p
+    sql = "SELECT id, offset, length, date, sender, subject FROM messages"
+    if subqueries:
+      conditions.insert(0, "id IN (%s)" % " INTERSECT ".join(subqueries))
+    if conditions:
+      sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY date DESC LIMIT ?"
+    rows = self.db.execute(sql, params + date_params + [limit]).fetchall()
+    return [self._hit(row) for row in rows]
+
+  @staticmethod
+  def _hit(row: tuple) -> Hit:
+    id, offset, length, date, sender, subject = row
+    date = datetime.fromtimestamp(date).astimezone() if date is not None else None
+    return Hit(id, offset, length, date, sender, subject)
+
+  def get(self, id: int) -> Hit:
+    """Get indexed message by id"""
+    row = self.db.execute("SELECT id, offset, length, date, sender, subject FROM messages WHERE id = ?", (id,)).fetchone()
+    if not row:
+      raise Exception("message %d not found" % id)
+    return self._hit(row)
+
+  def open(self, hit: Hit) -> Message:
+    """Read the message of a hit from the archive directly by its byte offset"""
+    with open(self.path, "rb") as f:
+      f.seek(hit.offset)
+      f.readline()
+      return Message(hit.id, unescape_from(f.read(hit.length)))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
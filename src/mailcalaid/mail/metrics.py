@@ -0,0 +1,246 @@
+"""
+Metrics
+
+Per protocol command and per phase instrumentation for mail clients. Nothing is collected
+unless a :class:`Metrics` is passed to the client, the protocol objects are left untouched then.
+
+.. code-block:: python
+
+  metrics = Metrics()
+  metrics.add_hook(lambda kind, name, seconds, bytes_in, bytes_out, error: print(kind, name, seconds))
+  client = ImapClient(host, port, user, password, metrics=metrics)
+  with metrics.phase("list"):
+    for msg in metrics.timed(client.fetch_messages(1, 10, headeronly=True), "fetch"):
+      print(msg.subject)
+  metrics.dump("mailcalaid.prom")
+"""
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Iterable, Generator, Tuple
+import bisect
+import imaplib
+import logging
+import os
+import poplib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Hook = Callable[[str, str, float, int, int, bool], None]
+
+
+@dataclass
+class Series:
+  """Statistics of a command or a phase"""
+  count: int = 0
+  errors: int = 0
+  seconds: float = 0
+  bytes_in: int = 0
+  bytes_out: int = 0
+  buckets: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+  def observe(self, seconds: float, bytes_in: int, bytes_out: int, error: bool):
+    self.count += 1
+    self.errors += int(error)
+    self.seconds += seconds
+    self.bytes_in += bytes_in
+    self.bytes_out += bytes_out
+    self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+class Metrics:
+  """Collects latency, traffic and errors of protocol commands and processing phases
+
+  :param hooks: callables invoked on every observation with
+    `(kind, name, seconds, bytes_in, bytes_out, error)`, kind is either "command" or "phase"
+  """
+
+  def __init__(self, hooks: Iterable[Hook] = ()):
+    self.commands: Dict[str, Series] = {}
+    self.phases: Dict[str, Series] = {}
+    self.hooks = list(hooks)
+    self.lock = threading.Lock()
+
+  def add_hook(self, hook: Hook):
+    """Add a hook to be invoked on every observation"""
+    self.hooks.append(hook)
+
+  def observe(self, kind: str, name: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0, error: bool = False):
+    """Record an observation"""
+    series = self.commands if kind == "command" else self.phases
+    with self.lock:
+      if name not in series:
+        series[name] = Series()
+      series[name].observe(seconds, bytes_in, bytes_out, error)
+    for hook in self.hooks:
+      try:
+        hook(kind, name, seconds, bytes_in, bytes_out, error)
+      except Exception:
+        logger.exception("metrics hook %s failed", hook)
+
+  @contextmanager
+  def phase(self, name: str):
+    """Time a block of code as a phase"""
+    started_at = time.perf_counter()
+    error = False
+    try:
+      yield
+    except BaseException:
+      error = True
+      raise
+    finally:
+      self.observe("phase", name, time.perf_counter() - started_at, error=error)
+
+  def timed(self, iterable: Iterable, name: str) -> Generator:
+    """Time every step of an iterable as a phase, useful for generators doing I/O lazily"""
+    it = iter(iterable)
+    while True:
+      started_at = time.perf_counter()
+      try:
+        item = next(it)
+      except StopIteration:
+        return
+      except BaseException:
+        self.observe("phase", name, time.perf_counter() - started_at, error=True)
+        raise
+      self.observe("phase", name, time.perf_counter() - started_at)
+      yield item
+
+  def to_prometheus(self, prefix: str = "mailcalaid") -> str:
+    """Render metrics in Prometheus text exposition format"""
+    lines = []
+    with self.lock:
+      for kind, label, series in (("command", "command", self.commands), ("phase", "phase", self.phases)):
+        name = "%s_%s_duration_seconds" % (prefix, kind)
+        lines.append("# TYPE %s histogram" % name)
+        for key, s in sorted(series.items()):
+          cumulative = 0
+          for le, n in zip(LATENCY_BUCKETS + ("+Inf",), s.buckets):
+            cumulative += n
+            lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, key, le, cumulative))
+          lines.append('%s_sum{%s="%s"} %f' % (name, label, key, s.seconds))
+          lines.append('%s_count{%s="%s"} %d' % (name, label, key, s.count))
+        for metric, attr in (("errors", "errors"), ("received_bytes", "bytes_in"), ("sent_bytes", "bytes_out")):
+          if kind == "phase" and attr != "errors":
+            continue
+          name = "%s_%s_%s_total" % (prefix, kind, metric)
+          lines.append("# TYPE %s counter" % name)
+          for key, s in sorted(series.items()):
+            lines.append('%s{%s="%s"} %d' % (name, label, key, getattr(s, attr)))
+    return "\n".join(lines) + "\n"
+
+  def dump(self, path: str):
+    """Write metrics to a file in Prometheus text format, e.g. for node_exporter textfile collector"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+      f.write(self.to_prometheus())
+    os.replace(tmp, path)
+
+  def serve(self, port: int, host: str = "") -> ThreadingHTTPServer:
+    """Serve metrics over http in a background thread"""
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("serving metrics on %s:%d", host, port)
+    return server
+
+
+def instrument_imap(client: imaplib.IMAP4, metrics: Metrics):
+  """Patch an imaplib client instance to report every command to metrics"""
+  traffic = [0, 0]
+  pending: Dict[bytes, Tuple[str, float, int]] = {}
+  send, read, readline = client.send, client.read, client.readline
+  command, command_complete = client._command, client._command_complete
+
+  def _send(data):
+    traffic[1] += len(data)
+    return send(data)
+
+  def _read(size):
+    data = read(size)
+    traffic[0] += len(data)
+    return data
+
+  def _readline():
+    line = readline()
+    traffic[0] += len(line)
+    return line
+
+  def _command(name, *args):
+    label = name
+    if name == "UID" and args:
+      label = "UID %s" % args[0].upper()
+    started_at, out = time.perf_counter(), traffic[1]
+    try:
+      tag = command(name, *args)
+    except Exception:
+      metrics.observe("command", label, time.perf_counter() - started_at, 0, traffic[1] - out, True)
+      raise
+    pending[tag] = (label, started_at, traffic[1] - out)
+    return tag
+
+  def _command_complete(name, tag):
+    label, started_at, bytes_out = pending.pop(tag, (name, time.perf_counter(), 0))
+    received = traffic[0]
+    error = True
+    try:
+      typ, data = command_complete(name, tag)
+      error = typ != "OK"
+      return typ, data
+    finally:
+      metrics.observe("command", label, time.perf_counter() - started_at, traffic[0] - received, bytes_out, error)
+
+  client.send, client.read, client.readline = _send, _read, _readline
+  client._command, client._command_complete = _command, _command_complete
+
+
+def instrument_pop3(client: poplib.POP3, metrics: Metrics):
+  """Patch a poplib client instance to report every command to metrics"""
+  traffic = [0, 0]
+  putline, getline = client._putline, client._getline
+  shortcmd, longcmd = client._shortcmd, client._longcmd
+
+  def _putline(line):
+    traffic[1] += len(line) + 2
+    return putline(line)
+
+  def _getline():
+    line, octets = getline()
+    traffic[0] += octets
+    return line, octets
+
+  def wrap(cmd):
+    def _cmd(line):
+      label = line.split(" ", 1)[0].upper()
+      started_at, received, sent = time.perf_counter(), traffic[0], traffic[1]
+      error = True
+      try:
+        result = cmd(line)
+        error = False
+        return result
+      finally:
+        metrics.observe(
+          "command", label, time.perf_counter() - started_at,
+          traffic[0] - received, traffic[1] - sent, error,
+        )
+    return _cmd
+
+  client._putline, client._getline = _putline, _getline
+  client._shortcmd, client._longcmd = wrap(shortcmd), wrap(longcmd)
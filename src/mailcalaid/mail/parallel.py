@@ -0,0 +1,66 @@
+"""
+Parallel
+
+Parse messages in a process pool, so header decoding and MIME parsing of bulk operations scale
+across cores and overlap with fetching.
+
+.. code-block:: python
+
+  for msg in parse_in_parallel(client.fetch_messages(1, 1000, headeronly=True), workers=4):
+    print(msg.subject)
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Generator, List, Tuple
+import os
+from mailcalaid.mail.mailclient import Message
+
+# properties parsed by workers, they are cached on the returned messages
+PARSED_PROPERTIES = ("message", "subject", "sender", "date")
+
+
+def parse_messages(messages: List[Tuple[int, bytes]]) -> List[Message]:
+  """Parse a chunk of (msg_id, raw bytes), runs in worker processes"""
+  result = []
+  for msg_id, raw in messages:
+    msg = Message(msg_id, raw)
+    for name in PARSED_PROPERTIES:
+      try:
+        getattr(msg, name)
+      except Exception:
+        # left unparsed, the main process raises the error when the property is accessed
+        pass
+    result.append(msg)
+  return result
+
+
+def parse_in_parallel(
+  messages: Iterable[Message],
+  workers: int = 0,
+  chunk_size: int = 20,
+) -> Generator[Message, None, None]:
+  """Parse messages in a process pool, results come back in the original order
+
+  Messages are sent to workers in chunks while the next ones are being fetched, at most
+  2 * workers chunks are in flight so memory stays bounded.
+
+  :param messages: messages to be parsed, e.g. from `MailClient.fetch_messages`
+  :param int workers: number of worker processes, default to number of CPUs
+  :param int chunk_size: number of messages sent to a worker at a time
+  """
+  workers = workers or os.cpu_count() or 1
+  with ProcessPoolExecutor(workers) as pool:
+    pending = deque()
+    chunk = []
+    for msg in messages:
+      chunk.append((msg.msg_id, msg.msg))
+      if len(chunk) < chunk_size:
+        continue
+      pending.append(pool.submit(parse_messages, chunk))
+      chunk = []
+      while pending and (len(pending) > 2 * workers or pending[0].done()):
+        yield from pending.popleft().result()
+    if chunk:
+      pending.append(pool.submit(parse_messages, chunk))
+    while pending:
+      yield from pending.popleft().result()
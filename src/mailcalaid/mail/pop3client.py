@@ -2,8 +2,10 @@ import poplib
 import email.utils
 import email.header
 import logging
-from typing import Generator
-from mailcalaid.mail.mailclient import MailClient, Message
+from datetime import datetime
+from typing import Dict, Generator, Optional, Tuple
+from mailcalaid.mail.mailclient import MailClient, Message, MessageMeta
+from mailcalaid.mail.metrics import instrument_pop3
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +20,8 @@ class Pop3Client(MailClient):
       pop3client = poplib.POP3_SSL(host=self.host, port=self.port, timeout=self.timeout)
     else:
       pop3client = poplib.POP3(host=self.host, port=self.port, timeout=self.timeout)
+    if self.metrics:
+      instrument_pop3(pop3client, self.metrics)
     pop3client.user(self.user)
     pop3client.pass_(self.password)
     self.client = pop3client
@@ -33,6 +37,152 @@ class Pop3Client(MailClient):
     """Total size of all messages in mailbox"""
     return self.client.stat()[1]
 
+  def list_message_keys(self) -> Generator[Tuple[int, str, str], None, None]:
+    """List message id and unique id (UIDL) of all messages in mailbox with one command
+
+    Message-ID header is left empty, it would take one command per message to fetch
+    """
+    code, lines, octets = self.client.uidl()
+    for line in lines:
+      msg_id, uid = line.decode().split(" ", 1)
+      yield int(msg_id), uid, ""
+
+  def list_metadata(self, headers=True) -> Generator[MessageMeta, None, None]:
+    """List size, date and sender of all messages in mailbox
+
+    Sizes come from a single LIST command, date and sender take a header only TOP per message
+
+    :param bool headers: fetch date and sender, sizes only if False
+    """
+    code, lines, octets = self.client.list()
+    for line in lines:
+      msg_id, size = map(int, line.split())
+      if not headers:
+        yield MessageMeta(msg_id, size, None, "")
+        continue
+      msg = self.fetch_message(msg_id, headeronly=True)
+      yield MessageMeta(msg_id, size, msg.date, msg.sender_addr[1])
+
+  def locate_date(self, dt: datetime, from_end=False, window=8, dates: Dict[int, Optional[datetime]] = None) -> int:
+    """Locate the last message dated before dt, assuming messages are roughly in date order
+
+    POP3 has no SEARCH, the boundary is found by galloping then bisecting message ids with header
+    only TOP commands, O(log N) of them instead of a linear scan. Every probe is decided by the
+    majority of the next 3 dated messages, messages without a date are passed over, so a single
+    out of order message does not mislead the search.
+
+    :param datetime dt: date
+    :param bool from_end: gallop from the newest message, faster when dt is recent
+    :param int window: max number of consecutive messages without a date
+    :param dict dates: cache of message dates by id, filled by the probes
+    :return: message id, 0 if all messages seem to be dated after dt
+    """
+    total = self.total_messages
+    dates = {} if dates is None else dates
+
+    def is_before(msg_id: int) -> bool:
+      votes = []
+      for i in range(msg_id, min(msg_id + window, total + 1)):
+        if i not in dates:
+          dates[i] = self.fetch_message(i, headeronly=True).date
+        if dates[i] is not None:
+          votes.append(dates[i] < dt)
+          if len(votes) == 3:
+            break
+      return sum(votes) * 2 > len(votes)
+
+    # invariant: message lo is before dt and message hi is not, 0 and total + 1 are sentinels
+    lo, hi, step = 0, total + 1, 1
+    if from_end:
+      while hi - step >= 1 and not is_before(hi - step):
+        hi -= step
+        step *= 2
+      lo = max(hi - step, 0)
+    else:
+      while lo + step <= total and is_before(lo + step):
+        lo += step
+        step *= 2
+      hi = min(lo + step, total + 1)
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      if is_before(mid):
+        lo = mid
+      else:
+        hi = mid
+    logger.debug("located %s after message %s with %s fetches", dt, lo, len(dates))
+    return lo
+
+  def _select_by_date(self, dt: datetime, after: bool, window: int) -> Generator[int, None, None]:
+    total = self.total_messages
+    dates = {}
+    lo = self.locate_date(dt, from_end=after, window=window, dates=dates)
+    ids = range(total, max(lo - window, 0), -1) if after else range(1, min(lo + window, total) + 1)
+    for msg_id in ids:
+      if lo - window < msg_id <= lo + window:
+        if msg_id not in dates:
+          dates[msg_id] = self.fetch_message(msg_id, headeronly=True).date
+        date = dates[msg_id]
+        if date is None or (date < dt if after else date > dt):
+          logger.debug("skip message %s date %s %s %s", msg_id, date, "<" if after else ">", dt)
+          continue
+      yield msg_id
+
+  def _scan_by_date(self, dt: datetime, after: bool, headeronly: bool) -> Generator[Message, None, None]:
+    total = self.total_messages
+    if not total:
+      return
+    messages = self.fetch_messages(total, 1, headeronly) if after else self.fetch_messages(1, total, headeronly)
+    outside = 0
+    for msg in messages:
+      if msg.date is None:
+        logger.debug("skip message %s without date", msg.msg_id)
+        continue
+      if msg.date < dt if after else msg.date > dt:
+        logger.debug("skip message %s date %s", msg.msg_id, msg.date)
+        # the same majority of 3 as `locate_date`, a single out of order message does not end the scan
+        outside += 1
+        if outside == 3:
+          return
+        continue
+      outside = 0
+      yield msg
+
+  def fetch_messages_after(self, dt: datetime, headeronly=True) -> Generator[Message, None, None]:
+    """Fetch messages after date, newest first
+
+    Every message taken has to be fetched anyway, so instead of locating the boundary the mailbox
+    is scanned from the newest message until 3 dated messages in a row are before dt. Messages
+    without a date are skipped.
+
+    :param datetime dt: date
+    :param bool headeronly: fetch only header
+    """
+    return self._scan_by_date(dt, True, headeronly)
+
+  def fetch_messages_before(self, dt: datetime, headeronly=True) -> Generator[Message, None, None]:
+    """Fetch messages before date, oldest first, see `fetch_messages_after`
+
+    :param datetime dt: date
+    :param bool headeronly: fetch only header
+    """
+    return self._scan_by_date(dt, False, headeronly)
+
+  def mark_deleted_before(self, dt: datetime, window=8):
+    """Mark messages before date as deleted
+
+    Located by `locate_date`, messages more than `window` ids below the boundary are deleted by
+    their position without being fetched, only those within `window` ids around it are checked
+    by date and kept if they have none. Out of order messages far from the boundary are deleted
+    or kept by position.
+    """
+    for msg_id in self._select_by_date(dt, False, window):
+      self.mark_deleted(msg_id)
+
+  def mark_deleted_after(self, dt: datetime, window=8):
+    """Mark messages after date as deleted, see `mark_deleted_before`"""
+    for msg_id in self._select_by_date(dt, True, window):
+      self.mark_deleted(msg_id)
+
   def _fetch_message(self, msg_id:int, headeronly: bool) -> bytes:
     code, lines, octets = self.client.top(msg_id, 0) if headeronly else self.client.retr(msg_id)
     logger.debug("fetch message %d response code %s, octets %d", msg_id, code, octets)
@@ -0,0 +1,279 @@
+"""
+Sinks
+
+Archive writers for downloaded messages: mbox (optionally gzip/xz/zstd compressed), Maildir and
+tarballs of one .eml per message. Compression and disk writes run on a background writer thread
+fed through a bounded queue, so the mail protocol loop only stalls when the disk can not keep up
+for a whole queue of messages.
+
+.. code-block:: python
+
+  with open_sink("backup.mbox.zst") as sink:
+    for msg in client.fetch_messages(1, 1000):
+      sink.add(msg)
+"""
+from typing import Optional
+import gzip
+import io
+import logging
+import lzma
+import mailbox
+import os
+import queue
+import re
+import tarfile
+import threading
+import time
+from mailcalaid.mail.mailclient import Message
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("mbox", "mbox.gz", "mbox.xz", "mbox.zst", "maildir", "tar", "tar.gz", "tar.xz", "tar.zst")
+SUFFIXES = {".tgz": "tar.gz", ".txz": "tar.xz", ".tzst": "tar.zst", ".gz": "mbox.gz", ".xz": "mbox.xz", ".zst": "mbox.zst"}
+# mboxrd escaping, >From lines are quoted as well so that readers could revert it exactly
+FROM_RE = re.compile(rb"^(>*From )", re.M)
+
+# markers put into the queue along with messages
+FLUSH = object()
+CLOSE = object()
+
+
+def open_compressed(path: str, compression: str = "", mode: str = "ab"):
+  """Open file for writing, compressed by gz, xz or zst"""
+  if not compression:
+    return open(path, mode)
+  if compression == "gz":
+    return gzip.open(path, mode)
+  if compression == "xz":
+    return lzma.open(path, mode)
+  if compression == "zst":
+    try:
+      import zstandard
+    except ImportError:
+      raise Exception("zstandard is required for zst compression, install it by `pip install zstandard`")
+    return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+  raise Exception("unsupported compression %s" % compression)
+
+
+class Sink:
+  """Base class of archive writers
+
+  Subclasses implement `_write`, `_flush` and `_close`, which are called on the writer thread
+  only. Errors of the writer thread are raised on the next `add`, `flush` or `close`.
+
+  :param str path: archive path
+  :param int queue_size: max number of messages waiting to be written
+  """
+
+  def __init__(self, path: str, queue_size: int = 64):
+    self.path = path
+    self.count = 0
+    self.error: Optional[Exception] = None
+    self.queue = queue.Queue(queue_size)
+    self.thread = threading.Thread(target=self._run, name="sink-writer", daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        # keep draining after a failure so that producers never block on a full queue
+        if self.error is None:
+          if item is FLUSH:
+            self._flush()
+          elif item is CLOSE:
+            self._close()
+          else:
+            self._write(item)
+            self.count += 1
+      except Exception as e:
+        logger.exception("failed writing to %s", self.path)
+        self.error = e
+      finally:
+        self.queue.task_done()
+      if item is CLOSE:
+        return
+
+  def _check(self):
+    if self.error is not None:
+      raise self.error
+
+  def add(self, msg: Message):
+    """Queue message to be written, blocks while the queue is full"""
+    self._check()
+    self.queue.put(msg)
+
+  def flush(self):
+    """Wait until queued messages are written and flushed to disk"""
+    self._check()
+    self.queue.put(FLUSH)
+    self.queue.join()
+    self._check()
+
+  def close(self):
+    """Write queued messages and close the archive"""
+    if self.thread.is_alive():
+      self.queue.put(CLOSE)
+      self.thread.join()
+    self._check()
+
+  def _write(self, msg: Message):
+    raise NotImplementedError()
+
+  def _flush(self):
+    pass
+
+  def _close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class MboxSink(Sink):
+  """Append messages to a mbox file, optionally compressed
+
+  Compressed archives are written as a sequence of streams (gzip members, xz streams or zstd
+  frames), a new one is started after every flush, so flushed messages are readable even if
+  the process is killed afterward.
+
+  :param str path: mbox file
+  :param str compression: one of gz, xz and zst, empty for plain mbox
+  """
+
+  def __init__(self, path: str, compression: str = "", queue_size: int = 64):
+    self.compression = compression
+    self.empty = not os.path.exists(path) or os.path.getsize(path) == 0
+    self.file = open_compressed(path, compression)
+    super().__init__(path, queue_size)
+
+  def _write(self, msg: Message):
+    if self.file is None:
+      self.file = open_compressed(self.path, self.compression)
+    raw = FROM_RE.sub(rb">\1", msg.msg.replace(b"\r\n", b"\n"))
+    if not raw.endswith(b"\n"):
+      raw += b"\n"
+    # same layout as `mailbox.mbox`: messages are separated by an empty line
+    if not self.empty:
+      self.file.write(b"\n")
+    self.file.write(b"From MAILER-DAEMON " + time.asctime(time.gmtime()).encode() + b"\n")
+    self.file.write(raw)
+    self.empty = False
+
+  def _flush(self):
+    if self.file is None:
+      return
+    if self.compression:
+      # finish the stream, compressors could not be flushed to a readable state otherwise
+      self.file.close()
+      self.file = None
+    else:
+      self.file.flush()
+
+  def _close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+class MaildirSink(Sink):
+  """Add messages to a Maildir, one file per message
+
+  :param str path: Maildir directory, created if not exists, an existing one must be empty or a
+    Maildir
+  """
+
+  def __init__(self, path: str, queue_size: int = 64):
+    if os.path.isdir(path) and os.listdir(path) and not all(os.path.isdir(os.path.join(path, d)) for d in ("cur", "new")):
+      raise Exception("%s is neither empty nor a Maildir" % path)
+    # `mailbox.Maildir` creates subdirectories only if the directory itself does not exist yet
+    for d in ("tmp", "new", "cur"):
+      os.makedirs(os.path.join(path, d), exist_ok=True)
+    self.maildir = mailbox.Maildir(path, create=False)
+    super().__init__(path, queue_size)
+
+  def _write(self, msg: Message):
+    self.maildir.add(msg.msg)
+
+
+class TarSink(Sink):
+  """Write messages into a tarball as 000001.eml, 000002.eml...
+
+  Plain tarballs are appended to, compressed ones must not exist yet and are complete only
+  after `close`.
+
+  :param str path: tarball path
+  :param str compression: one of gz, xz and zst, empty for plain tarball
+  """
+
+  def __init__(self, path: str, compression: str = "", queue_size: int = 64):
+    self.fileobj = None
+    if not compression:
+      self.tar = tarfile.open(path, "a")
+    elif os.path.exists(path):
+      raise Exception("could not append to compressed tarball %s" % path)
+    elif compression == "zst":
+      # tarfile has no zstd support, stream into a zstd writer instead
+      self.fileobj = open_compressed(path, compression, "xb")
+      self.tar = tarfile.open(fileobj=self.fileobj, mode="w|")
+    else:
+      self.tar = tarfile.open(path, "x:" + compression)
+    self.next_name = len(self.tar.getmembers()) + 1 if not compression else 1
+    super().__init__(path, queue_size)
+
+  def _write(self, msg: Message):
+    info = tarfile.TarInfo("%06d.eml" % self.next_name)
+    info.size = len(msg.msg)
+    try:
+      info.mtime = msg.date.timestamp() if msg.date else time.time()
+    except Exception:
+      info.mtime = time.time()
+    self.tar.addfile(info, io.BytesIO(msg.msg))
+    self.next_name += 1
+
+  def _flush(self):
+    if self.fileobj is None:
+      self.tar.fileobj.flush()
+
+  def _close(self):
+    self.tar.close()
+    if self.fileobj is not None:
+      self.fileobj.close()
+
+
+def guess_format(path: str) -> str:
+  """Guess archive format by path, directories are Maildir, unknown suffixes are plain mbox
+
+  Directories which are not Maildirs are refused by `MaildirSink` rather than guessed otherwise
+  """
+  if os.path.isdir(path) or path.endswith(("/", os.sep)):
+    return "maildir"
+  name = os.path.basename(path).lower()
+  for fmt in sorted(FORMATS, key=len, reverse=True):
+    if name.endswith("." + fmt):
+      return fmt
+  for suffix, fmt in SUFFIXES.items():
+    if name.endswith(suffix):
+      return fmt
+  return "mbox"
+
+
+def open_sink(path: str, format: str = "", queue_size: int = 64) -> Sink:
+  """Open archive sink of given format, guessed by path if empty
+
+  :param str path: archive path
+  :param str format: one of `FORMATS`
+  :param int queue_size: max number of messages waiting to be written
+  """
+  format = format or guess_format(path)
+  if format not in FORMATS:
+    raise Exception("unsupported archive format %s" % format)
+  kind, _, compression = format.partition(".")
+  if kind == "maildir":
+    return MaildirSink(path, queue_size)
+  if kind == "tar":
+    return TarSink(path, compression, queue_size)
+  return MboxSink(path, compression, queue_size)
@@ -0,0 +1,103 @@
+"""
+Stats
+
+Streaming aggregation of message metadata, answers "who/what takes the space" without
+downloading message bodies.
+
+.. code-block:: python
+
+  stats = MailboxStats()
+  for meta in client.list_metadata():
+    stats.add(meta, folder=client.mailbox)
+  for key, count, size in stats.top("sender", 10):
+    print(key, count, size)
+"""
+from typing import Dict, List, Tuple
+import heapq
+from mailcalaid.mail.mailclient import MessageMeta
+
+DIMENSIONS = ("sender", "domain", "month", "folder")
+
+
+def format_size(size: int) -> str:
+  """Human readable size"""
+  for unit in ("B", "KB", "MB", "GB"):
+    if size < 1024:
+      return "%d%s" % (size, unit) if unit == "B" else "%.1f%s" % (size, unit)
+    size /= 1024
+  return "%.1fTB" % size
+
+
+class MailboxStats:
+  """Message count and size aggregated by sender, domain, month and folder
+
+  Memory is bounded by max_keys per dimension, not by the number of messages. Once a dimension
+  holds max_keys keys, a new key replaces the one with the smallest size and inherits its count
+  and size (Space-Saving), which are kept as the error of the new key. The reported size of a key
+  overestimates by at most its size error, count and size minus their errors are lower bounds,
+  keys without error are exact.
+
+  :param int max_keys: max number of distinct keys kept per dimension
+  """
+
+  def __init__(self, max_keys: int = 10000):
+    self.max_keys = max_keys
+    self.count = 0
+    self.size = 0
+    # key to [count, size, count error, size error]
+    self.aggregations: Dict[str, Dict[str, List[int]]] = {d: {} for d in DIMENSIONS}
+    # min heaps of (size, key) by dimension, built once a dimension is full, sizes may be stale
+    self.heaps: Dict[str, List[Tuple[int, str]]] = {}
+
+  def add(self, meta: MessageMeta, folder: str = ""):
+    """Add a message to the aggregations"""
+    self.count += 1
+    self.size += meta.size
+    sender = meta.sender.lower() if meta.sender else "?"
+    keys = {
+      "sender": sender,
+      "domain": sender.rpartition("@")[2] or "?",
+      "month": meta.date.strftime("%Y-%m") if meta.date else "?",
+      "folder": folder or "?",
+    }
+    for dimension, key in keys.items():
+      agg = self.aggregations[dimension]
+      entry = agg.get(key)
+      if entry is None:
+        if len(agg) < self.max_keys:
+          agg[key] = [1, meta.size, 0, 0]
+          continue
+        count, size, _, _ = agg.pop(self._pop_min(dimension))
+        entry = agg[key] = [count + 1, size + meta.size, count, size]
+        heapq.heappush(self.heaps[dimension], (entry[1], key))
+      else:
+        entry[0] += 1
+        entry[1] += meta.size
+
+  def _pop_min(self, dimension: str) -> str:
+    agg = self.aggregations[dimension]
+    heap = self.heaps.get(dimension)
+    if heap is None:
+      heap = self.heaps[dimension] = [(entry[1], key) for key, entry in agg.items()]
+      heapq.heapify(heap)
+    while True:
+      size, key = heapq.heappop(heap)
+      # sizes only grow, an outdated one is pushed back with the current size
+      if agg[key][1] == size:
+        return key
+      heapq.heappush(heap, (agg[key][1], key))
+
+  def top(self, dimension: str, n: int = 10, by: str = "size") -> List[Tuple[str, int, int]]:
+    """Top n (key, count, size) of a dimension ordered by size or count, month is ordered by key"""
+    agg = self.aggregations[dimension]
+    if dimension == "month":
+      items = sorted(agg.items())[-n:]
+    else:
+      idx = 1 if by == "size" else 0
+      items = sorted(agg.items(), key=lambda kv: kv[1][idx], reverse=True)[:n]
+    return [(key, count, size) for key, (count, size, _, _) in items]
+
+  def error(self, dimension: str, key: str) -> Tuple[int, int]:
+    """Errors of (count, size) of a key, both are 0 if its numbers are exact"""
+    entry = self.aggregations[dimension].get(key)
+    return (entry[2], entry[3]) if entry else (0, 0)
@@ -1,12 +1,14 @@
 import json
 import re
-from time import sleep
 import logging
 import os
+import threading
+from queue import Queue
 from urllib import request
 from string import Template
+from contextlib import contextmanager
 from datetime import datetime, time, timedelta
-from mailcalaid.mail import ImapClient, Pop3Client
+from mailcalaid.mail import ImapClient, Pop3Client, Metrics
 from configparser import ConfigParser
 
 logging.basicConfig(format='[%(asctime)s] %(name)s: %(message)s', level=logging.INFO)
@@ -31,6 +33,10 @@ else:
 
 general_config = config["general"]
 interval = general_config.getint("interval", 60)
+# concurrency of checking stages: header fetching/filtering -> body fetching -> notifying
+body_workers = max(general_config.getint("body_workers", 4), 1)
+notify_workers = max(general_config.getint("notify_workers", 2), 1)
+queue_size = general_config.getint("queue_size", 100)
 workhours_start = general_config.getint("workhours_start", 9)
 workhours_end = general_config.getint("workhours_end", 18)
 cache_dir = general_config.get("cahce_dir", "cache")
@@ -67,6 +73,26 @@ if bothook_headers_config:
 bothook_body_tpl = bothook_config["bothook_body"]
 bothook_body_tpl =  Template(bothook_body_tpl)
 
+metrics = None
+metrics_file = None
+if config.has_section("metrics"):
+  metrics_config = config["metrics"]
+  metrics = Metrics()
+  metrics_file = metrics_config.get("file")
+  if metrics_file and not metrics_file.startswith("/") and config_dir:
+    metrics_file = os.path.join(config_dir, metrics_file)
+  metrics_port = metrics_config.getint("port")
+  if metrics_port:
+    metrics.serve(metrics_port)
+
+@contextmanager
+def phase(name):
+  if metrics:
+    with metrics.phase(name):
+      yield
+  else:
+    yield
+
 def notify_bothook(detail):
   subject = detail.subject
   localdate = datetime.fromtimestamp(detail.date.timestamp())
@@ -98,7 +124,7 @@ def notify_bothook(detail):
     logger.info(f"notify for {subject} status: {res.status}")
 
 
-def checkmail(previous_started_at: datetime) -> datetime:
+def open_client():
   kwargs = dict(
     host=host,
     port=port,
@@ -106,18 +132,122 @@ def checkmail(previous_started_at: datetime) -> datetime:
     password=passwd,
     ssl=ssl,
     timeout=timeout,
+    metrics=metrics,
   )
-  client = ImapClient(**kwargs) if proto=="imap" else Pop3Client(**kwargs)
-  for msg in client.fetch_messages_after(previous_started_at, headeronly=True):
-    if subject_keyword not in msg.subject:
-      continue
-    realname, fromaddr = msg.sender_addr
-    if fromaddr not in fromaddrs:
-      continue
-    if realname in ignore_realnames:
-      continue
-    notify_bothook(client.fetch_message(msg.msg_id))
-  client.close()
+  with phase("connect"):
+    return ImapClient(**kwargs) if proto=="imap" else Pop3Client(**kwargs)
+
+def match(msg) -> bool:
+  if subject_keyword not in msg.subject:
+    return False
+  realname, fromaddr = msg.sender_addr
+  if fromaddr not in fromaddrs:
+    return False
+  if realname in ignore_realnames:
+    return False
+  return True
+
+def checkmail(previous_started_at: datetime) -> datetime:
+  """Check mails since previous_started_at in a pipeline of bounded queues
+
+  Headers are fetched and filtered on the calling thread, bodies are fetched by `body_workers`
+  threads with a connection each (imap only), and hooks are sent by `notify_workers` threads.
+  Full queues hold the upstream stage back.
+
+  :return: date of the oldest matched message failed to be processed, None if all succeeded
+  """
+  bodies = Queue(queue_size)
+  notifies = Queue(queue_size)
+  failed = []
+  lock = threading.Lock()
+
+  def fail(msg):
+    with lock:
+      failed.append(msg.date or previous_started_at)
+
+  def fetch_bodies():
+    client = None
+    while True:
+      msg = bodies.get()
+      if msg is None:
+        break
+      try:
+        if client is None:
+          client = open_client()
+        with phase("fetch_body"):
+          detail = client.fetch_message(msg.msg_id)
+        # message ids are per connection, make sure it is the same message
+        if detail.message_id != msg.message_id:
+          raise Exception("message %s changed from %s to %s" % (msg.msg_id, msg.message_id, detail.message_id))
+        notifies.put((msg, detail))
+      except Exception:
+        logger.exception("failed to fetch message %s %s", msg.msg_id, msg.subject)
+        fail(msg)
+        if client is not None:
+          try:
+            client.close()
+          except Exception:
+            pass
+          client = None
+    if client is not None:
+      client.close()
+
+  def notify():
+    while True:
+      item = notifies.get()
+      if item is None:
+        break
+      msg, detail = item
+      try:
+        with phase("notify"):
+          notify_bothook(detail)
+      except Exception:
+        logger.exception("failed to notify for message %s %s", msg.msg_id, msg.subject)
+        fail(msg)
+
+  def start(target, n):
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(n)]
+    for thread in threads:
+      thread.start()
+    return threads
+
+  # pop3 maildrops are locked by a session, bodies are fetched over the header connection then
+  body_threads = start(fetch_bodies, body_workers if proto == "imap" else 0)
+  notify_threads = start(notify, notify_workers)
+  try:
+    client = open_client()
+    try:
+      headers = client.fetch_messages_after(previous_started_at, headeronly=True)
+      if metrics:
+        headers = metrics.timed(headers, "fetch_headers")
+      for msg in headers:
+        with phase("filter"):
+          matched = match(msg)
+        if not matched:
+          continue
+        if body_threads:
+          bodies.put(msg)
+          continue
+        try:
+          with phase("fetch_body"):
+            detail = client.fetch_message(msg.msg_id)
+          notifies.put((msg, detail))
+        except Exception:
+          logger.exception("failed to fetch message %s %s", msg.msg_id, msg.subject)
+          fail(msg)
+    finally:
+      client.close()
+  finally:
+    # drain the pipeline stage by stage, matched messages are processed even if fetching headers failed
+    for _ in body_threads:
+      bodies.put(None)
+    for thread in body_threads:
+      thread.join()
+    for _ in notify_threads:
+      notifies.put(None)
+    for thread in notify_threads:
+      thread.join()
+  return min(failed) if failed else None
 
 state_config = state["state"]
 def stateful_checkmail():
@@ -131,7 +261,11 @@ def stateful_checkmail():
   logger.info("start checking new mails since %s", previous_started_at)
   started_at = datetime.now()
   try:
-    checkmail(previous_started_at)
+    failed_at = checkmail(previous_started_at)
+    if failed_at:
+      # state never advances past a message not processed yet, it is retried on next check
+      logger.warning("some messages failed to be processed, the oldest one dated %s", failed_at)
+      started_at = min(started_at, datetime.fromtimestamp(failed_at.timestamp()))
     state_config["previous_started_at"] = started_at.strftime(config_datetime_fmt)
     if not dry_run:
       with open(state_file, "w", encoding="utf8") as f:
@@ -139,6 +273,8 @@ def stateful_checkmail():
     logger.info("done checking new mails, next since would be %s", started_at)
   except Exception:
     logger.exception("failed to check new mails")
+  if metrics_file:
+    metrics.dump(metrics_file)
 
 
 
@@ -148,7 +284,7 @@ parser.add_argument("--dry-run", action="store_true", default=False)
 args = parser.parse_args()
 dry_run = args.dry_run
 
-from mailcalaid.cal.holiday import ChinaHolidayBook
+from mailcalaid.cal.holiday import ChinaHolidayBook, run_periodically
 cn_holiday_book=None
 if not dry_run:
   cn_holiday_book = ChinaHolidayBook(
@@ -156,7 +292,4 @@ if not dry_run:
     workhours_start=time(hour=workhours_start),
     workhours_end=time(hour=workhours_end),
   )
-while True:
-  if dry_run or cn_holiday_book.is_workhour():
-    stateful_checkmail()
-  sleep(interval)
\ No newline at end of file
+run_periodically(stateful_checkmail, interval, cn_holiday_book)
\ No newline at end of file
@@ -1,31 +1,167 @@
 import argparse
 import os
+import sys
+import shlex
 import logging
-import mailbox
 from datetime import datetime
-from mailcalaid.mail import Pop3Client, ImapClient
+
+# mail libraries are imported lazily in `open_client`, commands which need no server (help,
+# parsing errors) should not pay for them
 
 def mailboxes_command(args):
-  for mailbox in args.client.list_mailboxes():
-    print(mailbox)
+  if not args.status:
+    for mailbox in args.client.list_mailboxes():
+      print(mailbox)
+    return
+  from mailcalaid.mail.stats import format_size
+  print("{0:40} {1:>8} {2:>8} {3:>10}".format("mailbox", "messages", "unseen", "size"))
+  for status in args.client.list_mailbox_status():
+    size = format_size(status["size"]) if status["size"] is not None else "-"
+    print("{0:40} {1:>8} {2:>8} {3:>10}".format(status["name"][:40], status["messages"], status["unseen"], size))
+
+def fetch_messages(args, msg_id, msg_id_end, headeronly=False):
+  messages = args.client.fetch_messages(msg_id, msg_id_end, headeronly=headeronly)
+  if args.workers:
+    from mailcalaid.mail.parallel import parse_in_parallel
+    messages = parse_in_parallel(messages, args.workers)
+  return messages
 
 def list_command(args):
   msg_id = (args.page - 1) * args.page_size + 1
   msg_id_end = msg_id + args.page_size - 1
-  for msg in args.client.fetch_messages(msg_id, msg_id_end, headeronly=not args.full):
+  for msg in fetch_messages(args, msg_id, msg_id_end, headeronly=not args.full):
     print("{0:3} {1} {2:40} {3}".format(msg.msg_id, msg.date.isoformat() if msg.date else "?", msg.sender[:38], msg.subject))
 
 def download_command(args):
-  download = mailbox.mbox(args.download, create=True)
-  # download.lock()
+  if args.incremental:
+    from mailcalaid.mail.backup import incremental_backup
+    added, skipped = incremental_backup(args.client, args.download, format=args.format)
+    print("%d messages archived, %d skipped" % (added, skipped))
+    return
+  from mailcalaid.mail.sinks import open_sink
   if not args.id:
     args.id = 1
   if not args.id_end:
     args.id_end = args.client.total_messages
-  for msg in args.client.fetch_messages(args.id, args.id_end):
-    download.add(msg.message)
-  download.flush()
-  # archive.unlock()
+  # sinks write raw bytes only, parsing in workers would just double the bytes passed between processes
+  with open_sink(args.download, args.format) as download:
+    for msg in args.client.fetch_messages(args.id, args.id_end):
+      download.add(msg)
+
+def stats_command(args):
+  from mailcalaid.mail.stats import MailboxStats, format_size, DIMENSIONS
+  stats = MailboxStats()
+  if args.all_folders and args.proto == "imap":
+    folders = [mailbox["name"].strip('"') for mailbox in args.client.list_mailboxes() if "\\Noselect" not in mailbox["flags"]]
+  else:
+    folders = [args.mailbox if args.proto == "imap" else "INBOX"]
+  for folder in folders:
+    if args.proto == "imap":
+      args.client.select(folder)
+      metas = args.client.list_metadata()
+    else:
+      metas = args.client.list_metadata(headers=not args.size_only)
+    for meta in metas:
+      stats.add(meta, folder)
+  print("total {0} messages, {1}".format(stats.count, format_size(stats.size)))
+  for dimension in DIMENSIONS:
+    print()
+    print("{0:50} {1:>8} {2:>10}".format("by " + dimension, "count", "size"))
+    for key, count, size in stats.top(dimension, args.top, args.by):
+      count_error, size_error = stats.error(dimension, key)
+      if count_error or size_error:
+        # approximate, numbers minus errors are lower bounds
+        print("{0:50} {1:>8} {2:>10}  (at least {3}, {4})".format(
+          key[:50], "~%d" % count, "~" + format_size(size), count - count_error, format_size(size - size_error)))
+      else:
+        print("{0:50} {1:>8} {2:>10}".format(key[:50], count, format_size(size)))
+
+def index_command(args):
+  from mailcalaid.mail.mboxindex import MboxIndex
+  with MboxIndex(args.mbox) as index:
+    if args.rebuild:
+      index.clear()
+    print("%d messages indexed" % index.update())
+
+def find_command(args):
+  from mailcalaid.mail.mboxindex import MboxIndex
+  with MboxIndex(args.mbox) as index:
+    index.update()
+    if args.show:
+      msg = index.open(index.get(args.show))
+      print("-------------------------------------------------")
+      print("Subject  ", msg.subject)
+      print("Date     ", msg.date)
+      print("From     ", msg.sender)
+      print()
+      print(msg.plain or msg.html)
+      return
+    for hit in index.search(" ".join(args.query), limit=args.limit):
+      print("{0:5} {1} {2:40} {3}".format(hit.id, hit.date.isoformat() if hit.date else "?", hit.sender[:38], hit.subject))
+
+def search_command(args):
+  from mailcalaid.mail.imapclient import search_criteria
+  if args.proto != "imap":
+    raise Exception("search is imap only")
+  client = args.client
+  criteria = search_criteria(
+    sender=args.sender,
+    subject=args.subject,
+    since=args.since,
+    before=args.before,
+    larger=args.larger,
+    smaller=args.smaller,
+    flags=args.flag or (),
+    text=args.text,
+    literal_plus="LITERAL+" in client.client.capabilities,
+  )
+  charset = None if criteria.isascii() else "UTF-8"
+  if args.folder:
+    folders = args.folder
+  elif args.all_folders:
+    folders = [mailbox["name"].strip('"') for mailbox in client.list_mailboxes() if "\\Noselect" not in mailbox["flags"]]
+  else:
+    folders = [args.mailbox]
+
+  def search(client, folder):
+    if folder != client.mailbox:
+      client.select(folder)
+    msg_ids = [int(i) for i in client.search(criteria, charset) or ()]
+    # newest hits only, headers fetched in bulk
+    hits = msg_ids[-args.limit:][::-1] if args.limit else msg_ids[::-1]
+    return folder, len(msg_ids), list(client.fetch_messages(hits, None, headeronly=True))
+
+  def show(folder, total, messages):
+    print("{0}: {1} messages found".format(folder, total))
+    for msg in messages:
+      print("{0:5} {1} {2:40} {3}".format(msg.msg_id, msg.date.isoformat() if msg.date else "?", msg.sender[:38], msg.subject))
+
+  if args.jobs <= 1 or len(folders) == 1:
+    for folder in folders:
+      show(*search(client, folder))
+    return
+
+  # folders are searched concurrently, a connection for each thread
+  import threading
+  from concurrent.futures import ThreadPoolExecutor, as_completed
+  local = threading.local()
+  clients = []
+  lock = threading.Lock()
+
+  def search_in_thread(folder):
+    if getattr(local, "client", None) is None:
+      local.client = open_client(args)
+      with lock:
+        clients.append(local.client)
+    return search(local.client, folder)
+
+  try:
+    with ThreadPoolExecutor(min(args.jobs, len(folders))) as pool:
+      for future in as_completed([pool.submit(search_in_thread, folder) for folder in folders]):
+        show(*future.result())
+  finally:
+    for c in clients:
+      c.close()
 
 def show_command(args):
   msg_id = args.id
@@ -52,80 +188,243 @@ def delete_command(args):
     args.client.mark_deleted_all()
   args.client.flush()
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--proto", default=os.getenv("MAIL_PROTO"), help="pop3, imap")
-parser.add_argument("--host", default=os.getenv("MAIL_HOST"), help="mail server host")
-parser.add_argument("--port", default=os.getenv("MAIL_PORT"), type=int, help="mail server port")
-parser.add_argument("--user", default=os.getenv("MAIL_USER"), help="mail user")
-parser.add_argument("--passwd", default=os.getenv("MAIL_PASSWD"), help="mail password")
-parser.add_argument("--ssl", default=os.getenv("MAIL_SSL"), action="store_true", help="use ssl")
-parser.add_argument("--debug", action="store_true", help="show debugging log")
-parser.add_argument("--dry-run", action="store_true", help="swallow all writing/deleting operations")
-parser.add_argument("--mailbox", default="INBOX", help="select remote mailbox (imap only)")
-# parser.add_argument("--batch", type=int, default=100, help="batch size when process massive amount of records. e.g. fetching thousands of messages.")
-
-subparsers = parser.add_subparsers(title='subcommands',
-                                   description='valid subcommands',
-                                   help='additional help')
-
-parser_mailboxes = subparsers.add_parser("mailboxes", help="list mailboxes (imap only)")
-parser_mailboxes.set_defaults(command=mailboxes_command)
-
-parser_list = subparsers.add_parser("list", help="list messages")
-parser_list.add_argument("page", nargs='?', type=int, default=1, help="page number")
-parser_list.add_argument("-s", "--page-size", type=int, default=10, help="page size")
-parser_list.add_argument("-f", "--full", action="store_true", help="fetch full message instead of header only")
-parser_list.set_defaults(command=list_command)
-
-parser_show = subparsers.add_parser("show", help="show message")
-parser_show.add_argument("id", type=int, help="message id")
-parser_show.set_defaults(command=show_command)
-
-parser_download = subparsers.add_parser("download", help="download messages")
-parser_download.add_argument("download", help="download mbox file")
-parser_download.add_argument("--id", type=int, help="message id / start id")
-parser_download.add_argument("--id-end", type=int, help="message id end")
-parser_download.set_defaults(command=download_command)
-
-parser_delete = subparsers.add_parser("delete", help="delete messages")
-parser_delete.add_argument("id", nargs='?', help="message id to be deleted")
-parser_delete.add_argument("--all", action="store_true")
-parser_delete.add_argument("--keep", type=int)
-parser_delete.add_argument("--after", type=lambda s: datetime.strptime(s, '%Y-%m-%d').astimezone())
-parser_delete.add_argument("--before", type=lambda s: datetime.strptime(s, '%Y-%m-%d').astimezone())
-parser_delete.set_defaults(command=delete_command)
+def batch_command(args):
+  f = sys.stdin if args.file == "-" else open(args.file, "r", encoding="utf8")
+  try:
+    lines = list(enumerate(f, 1))
+  finally:
+    if f is not sys.stdin:
+      f.close()
+  # every line is parsed before any of them runs, a typo must not surface after deletions ran
+  commands, errors = [], []
+  for lineno, line in lines:
+    try:
+      argv = shlex.split(line, comments=True)
+    except ValueError as e:
+      errors.append("%s:%d: %s: %s" % (args.file, lineno, e, line.strip()))
+      continue
+    if not argv:
+      continue
+    # options given to batch are inherited by every line unless overridden
+    base = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != "client"})
+    try:
+      sub_args = build_parser(argv)[0].parse_args(argv, namespace=base)
+    except SystemExit:
+      errors.append("%s:%d: invalid command: %s" % (args.file, lineno, line.strip()))
+      continue
+    if sub_args.command is batch_command:
+      errors.append("%s:%d: nested batch is not allowed" % (args.file, lineno))
+      continue
+    commands.append((lineno, line.strip(), sub_args))
+  if errors:
+    raise Exception("nothing run, %d invalid lines\n%s" % (len(errors), "\n".join(errors)))
+  for lineno, line, sub_args in commands:
+    logging.info("%s:%d: %s", args.file, lineno, line)
+    try:
+      run_command(sub_args, session=args)
+    except Exception:
+      if not args.keep_going:
+        raise
+      logging.exception("%s:%d: failed", args.file, lineno)
+
+def add_mailboxes_parser(subparsers):
+  parser_mailboxes = subparsers.add_parser("mailboxes", help="list mailboxes (imap only)")
+  parser_mailboxes.add_argument("-s", "--status", action="store_true", help="show message, unseen and size counts of every mailbox")
+  parser_mailboxes.set_defaults(command=mailboxes_command)
+
+def add_list_parser(subparsers):
+  parser_list = subparsers.add_parser("list", help="list messages")
+  parser_list.add_argument("page", nargs='?', type=int, default=1, help="page number")
+  parser_list.add_argument("-s", "--page-size", type=int, default=10, help="page size")
+  parser_list.add_argument("-f", "--full", action="store_true", help="fetch full message instead of header only")
+  parser_list.set_defaults(command=list_command)
+
+def add_show_parser(subparsers):
+  parser_show = subparsers.add_parser("show", help="show message")
+  parser_show.add_argument("id", type=int, help="message id")
+  parser_show.set_defaults(command=show_command)
+
+def add_download_parser(subparsers):
+  parser_download = subparsers.add_parser("download", help="download messages")
+  parser_download.add_argument("download", help="download archive: mbox file (.mbox/.mbox.gz/.mbox.xz/.mbox.zst), Maildir directory or tarball of .eml files (.tar/.tar.gz/.tar.xz/.tar.zst)")
+  parser_download.add_argument("--format", default="", help="archive format, guessed by file name by default: mbox, mbox.gz, mbox.xz, mbox.zst, maildir, tar, tar.gz, tar.xz, tar.zst")
+  parser_download.add_argument("--id", type=int, help="message id / start id")
+  parser_download.add_argument("--id-end", type=int, help="message id end")
+  parser_download.add_argument("-i", "--incremental", action="store_true", help="only download messages not archived yet, tracked by an index file next to the archive, compressed tarballs are not supported")
+  parser_download.set_defaults(command=download_command)
+
+def add_stats_parser(subparsers):
+  parser_stats = subparsers.add_parser("stats", help="show mailbox usage by sender, domain, month and folder without downloading bodies")
+  parser_stats.add_argument("-n", "--top", type=int, default=10, help="number of rows per table")
+  parser_stats.add_argument("--by", choices=("size", "count"), default="size", help="order rows by")
+  parser_stats.add_argument("-a", "--all-folders", action="store_true", help="all folders instead of the selected one (imap only)")
+  parser_stats.add_argument("--size-only", action="store_true", help="sizes from LIST only, skip per message header fetching (pop3 only)")
+  parser_stats.set_defaults(command=stats_command)
+
+def add_index_parser(subparsers):
+  parser_index = subparsers.add_parser("index", help="build or update full-text index of a downloaded mbox file (offline)")
+  parser_index.add_argument("mbox", help="mbox file")
+  parser_index.add_argument("--rebuild", action="store_true", help="rebuild index from scratch")
+  parser_index.set_defaults(command=index_command, online=False)
+
+def add_find_parser(subparsers):
+  parser_find = subparsers.add_parser("find", help="search messages in a downloaded mbox file (offline)")
+  parser_find.add_argument("mbox", help="mbox file")
+  parser_find.add_argument("query", nargs="*", help="words, field:word (subject/from/body), word*, since:YYYY-MM-DD, until:YYYY-MM-DD")
+  parser_find.add_argument("-l", "--limit", type=int, default=50, help="max number of hits")
+  parser_find.add_argument("--show", type=int, help="show message of given hit id")
+  parser_find.set_defaults(command=find_command, online=False)
+
+def add_search_parser(subparsers):
+  parser_search = subparsers.add_parser("search", help="search messages on server, only headers of hits are fetched (imap only)")
+  parser_search.add_argument("text", nargs="*", help="words in header or body")
+  parser_search.add_argument("--from", dest="sender", help="sender contains")
+  parser_search.add_argument("--subject", help="subject contains")
+  parser_search.add_argument("--since", type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), help="received on or after YYYY-MM-DD")
+  parser_search.add_argument("--before", type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), help="received before YYYY-MM-DD")
+  parser_search.add_argument("--larger", type=int, help="size larger than bytes")
+  parser_search.add_argument("--smaller", type=int, help="size smaller than bytes")
+  parser_search.add_argument("--flag", action="append", choices=("seen", "unseen", "flagged", "unflagged", "answered", "unanswered", "deleted", "undeleted", "draft", "undraft"), help="flag condition, could be repeated")
+  parser_search.add_argument("-f", "--folder", action="append", help="folder to search, could be repeated, default the selected mailbox")
+  parser_search.add_argument("-a", "--all-folders", action="store_true", help="search all folders")
+  parser_search.add_argument("-j", "--jobs", type=int, default=4, help="number of folders searched concurrently, each over its own connection")
+  parser_search.add_argument("-l", "--limit", type=int, default=50, help="max number of hits shown per folder, newest first, 0 for all")
+  parser_search.set_defaults(command=search_command)
+
+def add_delete_parser(subparsers):
+  parser_delete = subparsers.add_parser("delete", help="delete messages")
+  parser_delete.add_argument("id", nargs='?', help="message id to be deleted")
+  parser_delete.add_argument("--all", action="store_true")
+  parser_delete.add_argument("--keep", type=int)
+  parser_delete.add_argument("--after", type=lambda s: datetime.strptime(s, '%Y-%m-%d').astimezone())
+  parser_delete.add_argument("--before", type=lambda s: datetime.strptime(s, '%Y-%m-%d').astimezone())
+  parser_delete.set_defaults(command=delete_command)
 
 def help_command(args):
+  parser, subparsers = build_parser([args.name] if args.name else None)
   if args.name:
     subparsers.choices[args.name].print_help()
   else:
     parser.print_help()
-parser_help = subparsers.add_parser("help", help="show help")
-parser_help.add_argument("name", nargs='?', help="command name")
-parser_help.set_defaults(command=help_command)
-
-args = parser.parse_args()
-
-logging.basicConfig(format='[%(asctime)s] %(name)s: %(message)s', level=logging.DEBUG if args.debug else logging.INFO)
-
-if not (args.host and args.user and args.passwd):
-  parser.print_usage()
-  exit(1)
-
-kwargs= {
-  "host": args.host,
-  "port": args.port,
-  "user": args.user,
-  "password": args.passwd,
-  "ssl": args.ssl,
-  "batch_size": args.batch,
-  "dry_run": args.dry_run,
+
+def add_help_parser(subparsers):
+  parser_help = subparsers.add_parser("help", help="show help")
+  parser_help.add_argument("name", nargs='?', choices=SUBCOMMANDS.keys(), help="command name")
+  parser_help.set_defaults(command=help_command, online=False)
+
+def add_batch_parser(subparsers):
+  parser_batch = subparsers.add_parser("batch", help="run subcommands line by line from file over one session")
+  parser_batch.add_argument("file", nargs='?', default="-", help="file of subcommands, one per line, default stdin")
+  parser_batch.add_argument("-k", "--keep-going", action="store_true", help="keep going when a subcommand failed")
+  parser_batch.set_defaults(command=batch_command)
+
+# subcommand name to the function adding its parser, in the order shown by help
+SUBCOMMANDS = {
+  "mailboxes": add_mailboxes_parser,
+  "list": add_list_parser,
+  "show": add_show_parser,
+  "download": add_download_parser,
+  "stats": add_stats_parser,
+  "index": add_index_parser,
+  "find": add_find_parser,
+  "search": add_search_parser,
+  "delete": add_delete_parser,
+  "help": add_help_parser,
+  "batch": add_batch_parser,
 }
-if args.proto == "pop3":
-  args.client = Pop3Client(**kwargs)
-elif args.proto == "imap":
-  args.client = ImapClient(**kwargs)
-  if args.mailbox:
-    total_messages = args.client.select(args.mailbox)
-
-args.command(args)
\ No newline at end of file
+
+def build_parser(argv=None):
+  """Build the argument parser with subcommands named in argv plus help, all if argv names none
+
+  Every invocation runs a single subcommand, building the parsers of all others would be wasted.
+  Any argv token equal to a subcommand name registers it, so a mailbox named "list" given to
+  --mailbox costs an extra parser but never a missing one.
+
+  :return: parser and its subparsers action
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--proto", default=os.getenv("MAIL_PROTO"), help="pop3, imap")
+  parser.add_argument("--host", default=os.getenv("MAIL_HOST"), help="mail server host")
+  parser.add_argument("--port", default=os.getenv("MAIL_PORT"), type=int, help="mail server port")
+  parser.add_argument("--user", default=os.getenv("MAIL_USER"), help="mail user")
+  parser.add_argument("--passwd", default=os.getenv("MAIL_PASSWD"), help="mail password")
+  parser.add_argument("--ssl", default=os.getenv("MAIL_SSL"), action="store_true", help="use ssl")
+  parser.add_argument("--debug", action="store_true", help="show debugging log")
+  parser.add_argument("--dry-run", action="store_true", help="swallow all writing/deleting operations")
+  parser.add_argument("--mailbox", default="INBOX", help="select remote mailbox (imap only)")
+  parser.add_argument("--metrics", help="dump metrics of mail commands to file in prometheus text format")
+  parser.add_argument("--batch-size", type=int, default=100, help="batch size when process massive amount of records. e.g. fetching thousands of messages.")
+  parser.add_argument("--workers", type=int, default=0, help="parse messages in given number of processes when listing")
+  parser.set_defaults(command=None, online=True)
+
+  subparsers = parser.add_subparsers(title='subcommands',
+                                     description='valid subcommands',
+                                     help='additional help')
+  names = set(argv or ()) & SUBCOMMANDS.keys()
+  for name, add_parser in SUBCOMMANDS.items():
+    # without a subcommand, usage and errors list them all
+    if not names or name in names or name == "help":
+      add_parser(subparsers)
+  return parser, subparsers
+
+def open_client(args):
+  """Open the mail client and select the mailbox according to args"""
+  from mailcalaid.mail import Pop3Client, ImapClient, Metrics
+  if not (args.host and args.user and args.passwd):
+    build_parser()[0].print_usage()
+    exit(1)
+  kwargs= {
+    "host": args.host,
+    "port": args.port,
+    "user": args.user,
+    "password": args.passwd,
+    "ssl": args.ssl,
+    "batch_size": args.batch_size,
+    "dry_run": args.dry_run,
+    "metrics": Metrics() if args.metrics else None,
+  }
+  if args.proto == "pop3":
+    return Pop3Client(**kwargs)
+  elif args.proto == "imap":
+    client = ImapClient(**kwargs)
+    if args.mailbox and args.mailbox != client.mailbox:
+      client.select(args.mailbox)
+    return client
+  raise Exception("unsupported proto %s" % args.proto)
+
+def run_command(args, session=None):
+  """Run command of args, reusing the client of the session if given"""
+  if args.online:
+    if session is None:
+      args.client = open_client(args)
+    else:
+      if getattr(session, "client", None) is None:
+        session.client = open_client(session)
+      args.client = session.client
+      if session.proto == "imap" and args.mailbox != args.client.mailbox:
+        args.client.select(args.mailbox)
+  args.command(args)
+
+# guarded for worker processes which import this module on platforms spawning them
+if __name__ == "__main__":
+  parser, _ = build_parser(sys.argv[1:])
+  args = parser.parse_args()
+
+  logging.basicConfig(format='[%(asctime)s] %(name)s: %(message)s', level=logging.DEBUG if args.debug else logging.INFO)
+
+  if args.command is None:
+    parser.print_usage()
+    exit(1)
+
+  if args.command is batch_command:
+    args.client = None
+    try:
+      batch_command(args)
+    finally:
+      if args.client:
+        args.client.close()
+  else:
+    run_command(args)
+
+  if args.metrics and getattr(args, "client", None):
+    args.client.metrics.dump(args.metrics)
@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakeserver import FakeMailServer  # noqa: E402
+from mailcalaid.mail import ImapClient, Pop3Client  # noqa: E402
+
+
+@pytest.fixture(params=["imap", "pop3"])
+def proto(request) -> str:
+  """Protocol of fake servers, tests using it run against both"""
+  return request.param
+
+
+@pytest.fixture
+def start_server():
+  """Start fake mail servers, see `FakeMailServer` for arguments, they are stopped at teardown"""
+  servers = []
+
+  def start(messages, proto: str = "imap", **kwargs) -> FakeMailServer:
+    server = FakeMailServer(messages, proto=proto, **kwargs).start()
+    servers.append(server)
+    return server
+
+  yield start
+  for server in servers:
+    server.stop()
+
+
+@pytest.fixture
+def open_client():
+  """Open clients to fake servers by their protocol, closing them is up to the test"""
+
+  def open(server: FakeMailServer):
+    cls = ImapClient if server.proto == "imap" else Pop3Client
+    return cls(host=server.host, port=server.port, user="u", password="p", ssl=False)
+
+  return open
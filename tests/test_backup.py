@@ -0,0 +1,81 @@
+"""
+Incremental backups against the fake servers
+"""
+import dataclasses
+import lzma
+import mailbox
+import os
+import re
+import tarfile
+import pytest
+from fakeserver import generate_mailbox
+from mailcalaid.mail.backup import incremental_backup
+
+
+def duplicated_mailbox():
+  messages = generate_mailbox(20, attachment_ratio=0, size_mix=((1, 200),), seed=3)
+  # the same message delivered twice, without Message-ID only the content hash tells them apart
+  messages[5].raw = re.sub(rb"Message-ID: [^\r]*\r\n", b"", messages[5].raw)
+  messages.append(dataclasses.replace(messages[5], uid=21))
+  return messages
+
+
+@pytest.fixture
+def server(start_server, proto):
+  return start_server(duplicated_mailbox(), proto)
+
+
+@pytest.fixture
+def backup(server, open_client):
+  """Run an incremental backup of the fake server into a path"""
+
+  def run(path):
+    client = open_client(server)
+    try:
+      return incremental_backup(client, path)
+    finally:
+      client.close()
+
+  return run
+
+
+def test_second_run_fetches_nothing(server, backup, tmp_path):
+  path = str(tmp_path / "backup.mbox")
+  assert backup(path) == (20, 1)
+  size = (tmp_path / "backup.mbox").stat().st_size
+  server.reset_stats()
+  assert backup(path) == (0, 21)
+  assert (tmp_path / "backup.mbox").stat().st_size == size
+  # bodies are not fetched again, only the message keys are listed
+  commands = server.stats.commands
+  assert "RETR" not in commands
+  assert commands.get("FETCH", 0) <= 1
+
+
+def archived(path: str, format: str) -> int:
+  if format == "maildir":
+    return len(mailbox.Maildir(path, create=False))
+  if format == "tar":
+    with tarfile.open(path) as tar:
+      return len(tar.getmembers())
+  with lzma.open(path) as f:
+    return f.read().count(b"\nFrom MAILER-DAEMON ") + 1
+
+
+@pytest.mark.parametrize("name,format", [("backup.tar", "tar"), ("backup.mbox.xz", "mbox.xz"), ("md/", "maildir")])
+def test_second_run_appends_to_archive(server, backup, tmp_path, name, format):
+  # joined as strings, pathlib would drop the trailing slash of a Maildir
+  path = os.path.join(str(tmp_path), name)
+  assert backup(path) == (20, 1)
+  new = generate_mailbox(25, attachment_ratio=0, size_mix=((1, 200),), seed=4)[20:]
+  server.mailboxes["INBOX"].extend(dataclasses.replace(msg, uid=msg.uid + 1) for msg in new)
+  assert backup(path) == (5, 21)
+  assert archived(path, format) == 25
+  assert os.path.exists(path.rstrip("/") + ".index")
+
+
+@pytest.mark.parametrize("name", ["backup.tar.gz", "backup.tar.xz", "backup.tar.zst"])
+def test_compressed_tarball_refused(server, backup, tmp_path, name):
+  with pytest.raises(Exception, match="compressed tarball"):
+    backup(str(tmp_path / name))
+  assert not os.listdir(tmp_path)
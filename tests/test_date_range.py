@@ -0,0 +1,91 @@
+"""
+Date based fetching/deleting against the fake servers, mailboxes are not strictly date ordered
+"""
+from datetime import timedelta
+import email
+import email.utils
+import re
+import pytest
+from fakeserver import generate_mailbox
+
+
+def sent_date(raw: bytes):
+  value = email.message_from_bytes(raw)["Date"]
+  return email.utils.parsedate_to_datetime(value) if value else None
+
+
+def shuffled_mailbox():
+  messages = generate_mailbox(200, attachment_ratio=0, size_mix=((1, 200),), seed=7)
+  # a newer message at a low id and an older one at a high id
+  messages[2].raw, messages[189].raw = messages[189].raw, messages[2].raw
+  messages[149].raw, messages[10].raw = messages[10].raw, messages[149].raw
+  # local disorder around the cutoff
+  messages[118].raw, messages[121].raw = messages[121].raw, messages[118].raw
+  # neither Date nor Received header
+  for i in (4, 100, 119):
+    messages[i].raw = re.sub(rb"Date: [^\r]*\r\n", b"", messages[i].raw)
+  return messages
+
+
+@pytest.fixture
+def server(start_server, proto):
+  return start_server(shuffled_mailbox(), proto)
+
+
+def cutoff_of(server):
+  dates = sorted(d for d in (sent_date(m.raw) for m in server.mailboxes["INBOX"]) if d)
+  return dates[120] + timedelta(seconds=1)
+
+
+def test_fetch_before_and_after(server, open_client):
+  cutoff = cutoff_of(server)
+  client = open_client(server)
+  before = list(client.fetch_messages_before(cutoff))
+  after = list(client.fetch_messages_after(cutoff))
+  client.close()
+  assert before and after
+  assert all(msg.date <= cutoff for msg in before)
+  assert all(msg.date >= cutoff for msg in after)
+  # messages around the cutoff are found despite the local disorder
+  ids = {msg.msg_id for msg in before} | {msg.msg_id for msg in after}
+  assert set(range(110, 131)) - {101, 120} <= ids
+
+
+def delete(server, client, after: bool):
+  """Delete by date, return the cutoff, dates by uid before and uids remaining"""
+  cutoff = cutoff_of(server)
+  dates = {m.uid: sent_date(m.raw) for m in server.mailboxes["INBOX"]}
+  if after:
+    client.mark_deleted_after(cutoff)
+  else:
+    client.mark_deleted_before(cutoff)
+  client.flush()
+  client.close()
+  return cutoff, dates, {m.uid for m in server.mailboxes["INBOX"]}
+
+
+def test_delete_before_keeps_newer_and_undated(server, open_client):
+  cutoff, dates, remaining = delete(server, open_client(server), after=False)
+  if server.proto == "pop3":
+    # far from the located boundary messages are deleted or kept by their position, the out of
+    # order and undated ones included, around it by date
+    assert not any(uid < 100 for uid in remaining)
+    assert set(range(140, 201)) <= remaining
+    window = set(range(115, 129))
+    assert window & remaining == {uid for uid in window if dates[uid] is None or dates[uid] > cutoff}
+    # headers fetched are bounded by the locator and the window, not by the messages deleted
+    assert server.stats.commands["TOP"] < 60
+  else:
+    assert remaining == {uid for uid, d in dates.items() if d is None or d > cutoff}
+
+
+def test_delete_after_keeps_older_and_undated(server, open_client):
+  cutoff, dates, remaining = delete(server, open_client(server), after=True)
+  if server.proto == "pop3":
+    assert set(range(1, 100)) <= remaining
+    assert not any(uid > 140 for uid in remaining)
+    window = set(range(115, 129))
+    assert window & remaining == {uid for uid in window if dates[uid] is None or dates[uid] < cutoff}
+    assert server.stats.commands["TOP"] < 60
+  else:
+    assert remaining == {uid for uid, d in dates.items() if d is None or d < cutoff}
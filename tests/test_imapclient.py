@@ -0,0 +1,53 @@
+"""
+ImapClient against the fake IMAP server
+"""
+import pytest
+from fakeserver import generate_mailbox
+
+
+@pytest.fixture
+def client(start_server, open_client):
+  server = start_server(generate_mailbox(10, attachment_ratio=0, size_mix=((1, 200),), seed=6))
+  client = open_client(server)
+  yield client
+  client.close()
+
+
+@pytest.mark.parametrize("responses,exists", [
+  # new mail, then an expunge of an old message
+  ([("EXISTS", b"11"), ("EXPUNGE", b"3")], 10),
+  ([("EXPUNGE", b"3"), ("EXISTS", b"10")], 10),
+  ([("EXPUNGE", b"3"), ("EXPUNGE", b"3"), ("EXISTS", b"9"), ("EXPUNGE", b"1")], 8),
+  ([("VANISHED", b"2:3"), ("VANISHED", b"(EARLIER) 5"), ("EXISTS", b"9"), ("VANISHED", b"7")], 8),
+])
+def test_message_count_follows_arrival_order(client, responses, exists):
+  assert client.total_messages == 10
+  for typ, dat in responses:
+    client.client._append_untagged(typ, dat)
+  assert client.total_messages == exists
+  assert not client.client.untagged_responses.get("EXISTS")
+
+
+def test_message_count_after_expunge(client):
+  client.mark_deleted(2)
+  client.mark_deleted(5)
+  client.flush()
+  assert client.total_messages == 8
+
+
+@pytest.mark.parametrize("attr,items", [
+  ("MSG_KEYS", "(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)] UID)"),
+  ("MSG_META", "(BODY.PEEK[HEADER.FIELDS (FROM)] INTERNALDATE RFC822.SIZE)"),
+])
+def test_fetch_items_after_literal(client, attr, items):
+  expected = list(client.list_message_keys()), list(client.list_metadata())
+  # servers may put fetch items after the header literal
+  setattr(client, attr, items)
+  assert (list(client.list_message_keys()), list(client.list_metadata())) == expected
+  assert expected[0][0][1].endswith(":1") and expected[1][0].size > 0
+
+
+def test_fetch_item_missing(client):
+  client.MSG_META = "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM)])"
+  with pytest.raises(Exception, match="INTERNALDATE missing"):
+    list(client.list_metadata())
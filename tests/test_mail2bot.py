@@ -0,0 +1,122 @@
+"""
+mail2bot checking pipeline against the fake IMAP server
+"""
+import importlib
+import sys
+import threading
+from datetime import datetime
+import pytest
+from fakeserver import generate_mailbox
+from mailcalaid.mail import ImapClient
+
+CONFIG = """
+[general]
+body_workers = 2
+notify_workers = 2
+queue_size = 2
+
+[imap]
+proto = imap
+host = %s
+port = %d
+user = u
+passwd = p
+ssl = false
+
+[filter]
+subject_keyword = apache/incubator-devlake
+fromaddrs = notifications@github.com
+ignore_realnames =
+	Someone
+
+[bothook]
+link_re = (https://github.com/apache/incubator-devlake.*)$
+bothook_url = http://localhost/hook
+bothook_body = {"text": $subject_json, "link": "$link"}
+
+[bothook request headers]
+content-type = application/json
+"""
+
+
+@pytest.fixture
+def server(start_server):
+  return start_server(generate_mailbox(30, attachment_ratio=0, size_mix=((1, 200),), seed=6))
+
+
+@pytest.fixture
+def mail2bot(server, tmp_path, monkeypatch):
+  """Import mail2bot configured for the fake server, without running it periodically"""
+  (tmp_path / "mail2bot.ini").write_text(CONFIG % (server.host, server.port), encoding="utf8")
+  (tmp_path / "mail2bot_state.ini").write_text("[state]\nprevious_started_at = 2022-12-31 00:00:00\n", encoding="utf8")
+  monkeypatch.setenv("CONFIG_DIR", str(tmp_path))
+  monkeypatch.setattr(sys, "argv", ["mail2bot", "--dry-run"])
+  monkeypatch.setattr("mailcalaid.cal.holiday.run_periodically", lambda *args: None)
+  monkeypatch.delitem(sys.modules, "mailcalaid.mail2bot", raising=False)
+  module = importlib.import_module("mailcalaid.mail2bot")
+  notified = []
+  lock = threading.Lock()
+
+  def notify_bothook(detail):
+    with lock:
+      notified.append(detail.message_id)
+
+  monkeypatch.setattr(module, "notify_bothook", notify_bothook)
+  module.notified = notified
+  return module
+
+
+def matched(server, open_client):
+  client = open_client(server)
+  try:
+    messages = client.fetch_messages_after(datetime(2022, 12, 31).astimezone(), headeronly=True)
+    github = [msg for msg in messages if msg.sender_addr[1] == "notifications@github.com"]
+    return sorted(github, key=lambda msg: msg.date)
+  finally:
+    client.close()
+
+
+def fail_once(monkeypatch, obj, name, message_id):
+  """Make obj.name raise the first time it returns or is given the message"""
+  original = getattr(obj, name)
+  failed = []
+
+  def check(detail):
+    if detail.message_id == message_id and not failed:
+      failed.append(message_id)
+      raise Exception("boom")
+
+  def wrapper(*args):
+    if name == "notify_bothook":
+      check(args[-1])
+      return original(*args)
+    detail = original(*args)
+    check(detail)
+    return detail
+
+  monkeypatch.setattr(obj, name, wrapper)
+  return failed
+
+
+@pytest.mark.parametrize("stage", ["fetch_body", "notify"])
+def test_failed_message_is_retried_on_next_check(server, open_client, mail2bot, monkeypatch, stage):
+  messages = matched(server, open_client)
+  assert len(messages) > 3
+  failing = messages[2]
+  if stage == "fetch_body":
+    failed = fail_once(monkeypatch, ImapClient, "fetch_message", failing.message_id)
+  else:
+    failed = fail_once(monkeypatch, mail2bot, "notify_bothook", failing.message_id)
+
+  mail2bot.stateful_checkmail()
+  assert failed == [failing.message_id]
+  assert sorted(mail2bot.notified) == sorted(msg.message_id for msg in messages if msg is not failing)
+  # state stops at the failed message, so it is checked again
+  since = mail2bot.state_config["previous_started_at"]
+  assert since == datetime.fromtimestamp(failing.date.timestamp()).strftime(mail2bot.config_datetime_fmt)
+
+  del mail2bot.notified[:]
+  mail2bot.stateful_checkmail()
+  assert failing.message_id in mail2bot.notified
+  assert set(mail2bot.notified) == {msg.message_id for msg in messages[2:]}
+  assert mail2bot.state_config["previous_started_at"] > since
@@ -0,0 +1,50 @@
+"""
+mailaid command line against the fake IMAP server
+"""
+import pytest
+from fakeserver import generate_mailbox
+from mailcalaid import mailaid
+
+
+@pytest.fixture
+def server(start_server):
+  return start_server(generate_mailbox(10, attachment_ratio=0, size_mix=((1, 200),), seed=2))
+
+
+def run_batch(server, tmp_path, lines, *options):
+  path = tmp_path / "batch.txt"
+  path.write_text("\n".join(lines) + "\n", encoding="utf8")
+  argv = ["--proto", "imap", "--host", server.host, "--port", str(server.port), "--user", "u", "--passwd", "p"]
+  argv += ["batch", *options, str(path)]
+  args = mailaid.build_parser(argv)[0].parse_args(argv)
+  args.client = None
+  try:
+    mailaid.batch_command(args)
+  finally:
+    if args.client:
+      args.client.close()
+
+
+def test_batch_runs_lines_over_one_session(server, tmp_path):
+  run_batch(server, tmp_path, ["# cleanup", "delete 1", "", "delete 2  # second"])
+  # every delete is expunged before the next line, message ids shift
+  assert [m.uid for m in server.mailboxes["INBOX"]] == [2] + list(range(4, 11))
+  assert server.stats.connections == 1
+
+
+def test_batch_checks_every_line_before_running(server, tmp_path):
+  lines = ["delete 1", "delet 2", "list --page-size x", "batch other.txt", 'show "3']
+  with pytest.raises(Exception) as e:
+    run_batch(server, tmp_path, lines)
+  message = str(e.value)
+  assert "4 invalid lines" in message
+  for lineno in (2, 3, 4, 5):
+    assert "batch.txt:%d:" % lineno in message
+  # nothing ran, not even the valid first line
+  assert len(server.mailboxes["INBOX"]) == 10
+  assert server.stats.connections == 0
+
+
+def test_batch_keep_going(server, tmp_path):
+  run_batch(server, tmp_path, ["show 99", "delete 1"], "--keep-going")
+  assert len(server.mailboxes["INBOX"]) == 9
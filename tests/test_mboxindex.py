@@ -0,0 +1,94 @@
+"""
+Offline full-text index of mbox archives, `mailaid index` and `mailaid find`
+"""
+import pytest
+from mailcalaid import mailaid
+from mailcalaid.mail.mailclient import Message
+from mailcalaid.mail.mboxindex import MboxIndex
+from mailcalaid.mail.sinks import open_sink
+
+
+def raw(sender: str, subject: str, date: str, body: str) -> bytes:
+  return (
+    "From: %s\r\nSubject: %s\r\nDate: %s\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n%s\r\n"
+    % (sender, subject, date, body)
+  ).encode("utf-8")
+
+
+MESSAGES = [
+  raw("GitHub <noreply@github.com>", "[devlake] build failed", "Wed, 1 Mar 2023 10:00:00 +0000", "pipeline broke"),
+  raw("Alice <alice@example.com>", "lunch", "Thu, 2 Mar 2023 12:00:00 +0000", "devlake meetup after lunch"),
+  raw("GitHub <noreply@github.com>", "[devlake] release", "Mon, 6 Mar 2023 09:00:00 +0000", "released 0.15"),
+  raw("Bob <bob@example.com>", "会议通知", "Tue, 7 Mar 2023 09:00:00 +0000", "明天开会"),
+]
+
+
+def write(path: str, messages):
+  with open_sink(path, "mbox") as sink:
+    for i, data in enumerate(messages, 1):
+      sink.add(Message(i, data))
+
+
+@pytest.fixture
+def mbox(tmp_path):
+  path = str(tmp_path / "backup.mbox")
+  write(path, MESSAGES)
+  return path
+
+
+def subjects(index: MboxIndex, query: str):
+  return [hit.subject for hit in index.search(query)]
+
+
+def test_search(mbox):
+  with MboxIndex(mbox) as index:
+    assert index.update() == 4
+    # newest first, any field
+    assert subjects(index, "devlake") == ["[devlake] release", "lunch", "[devlake] build failed"]
+    assert subjects(index, "subject:devlake") == ["[devlake] release", "[devlake] build failed"]
+    assert subjects(index, "from:github since:2023-03-02") == ["[devlake] release"]
+    assert subjects(index, "from:github until:2023-03-02") == ["[devlake] build failed"]
+    assert subjects(index, "relea*") == ["[devlake] release"]
+    assert subjects(index, "会议") == ["会议通知"]
+    assert subjects(index, "devlake nothing") == []
+    hit = index.search("pipeline")[0]
+    assert "pipeline broke" in index.open(hit).plain
+
+
+def test_update_is_incremental(mbox):
+  with MboxIndex(mbox) as index:
+    assert index.update() == 4
+    assert index.update() == 0
+    write(mbox, [raw("Carol <carol@example.com>", "appended", "Wed, 8 Mar 2023 09:00:00 +0000", "late")])
+    assert index.update() == 1
+    assert len(index.search("devlake")) == 3
+    assert subjects(index, "appended") == ["appended"]
+
+
+def test_small_rewritten_archive_is_reindexed(mbox):
+  with MboxIndex(mbox) as index:
+    index.update()
+  # rewritten in place by a tool which dropped and reordered messages, smaller than HEAD_SIZE
+  with open(mbox, "wb"):
+    pass
+  write(mbox, list(reversed(MESSAGES)) + MESSAGES[:1])
+  with MboxIndex(mbox) as index:
+    assert index.update() == 5
+    for hit in index.search("devlake"):
+      assert index.open(hit).subject == hit.subject
+
+
+@pytest.mark.parametrize("query", ["since:2023-13-01", "until:yesterday"])
+def test_invalid_date(mbox, query):
+  with MboxIndex(mbox) as index:
+    with pytest.raises(Exception, match="invalid date in"):
+      index.search("devlake " + query)
+
+
+def test_find_command(mbox, capsys):
+  argv = ["find", mbox, "from:github", "devlake"]
+  args = mailaid.build_parser(argv)[0].parse_args(argv)
+  args.command(args)
+  lines = capsys.readouterr().out.splitlines()
+  assert len(lines) == 2
+  assert lines[0].endswith("[devlake] release") and lines[1].endswith("[devlake] build failed")
@@ -0,0 +1,50 @@
+"""
+Mailbox resynchronization by CONDSTORE/QRESYNC against the fake IMAP server
+"""
+import pytest
+from fakeserver import generate_mailbox
+
+CAPABILITIES = {
+  "condstore": ("ENABLE", "CONDSTORE"),
+  "qresync": ("ENABLE", "CONDSTORE", "QRESYNC"),
+}
+
+
+@pytest.fixture(params=sorted(CAPABILITIES))
+def server(request, start_server):
+  messages = generate_mailbox(10, attachment_ratio=0, size_mix=((1, 200),), seed=5)
+  return start_server(messages, capabilities=CAPABILITIES[request.param])
+
+
+def change_mailbox(server):
+  """Flag two messages and expunge another one behind the back of connected clients"""
+  messages = server.mailboxes["INBOX"]
+  for msg in messages[2:4]:
+    msg.flags.add("\\Seen")
+    msg.modseq = server.next_modseq("INBOX")
+  msg = messages.pop(6)
+  server.vanished["INBOX"].append((msg.uid, server.next_modseq("INBOX")))
+  return msg.uid
+
+
+def test_resync_reports_changes_and_current_modseq(server, open_client):
+  client = open_client(server)
+  state = client.uidvalidity, client.highestmodseq
+  expunged = change_mailbox(server)
+  changes = client.resync(*state)
+  assert not changes.reset
+  assert set(changes.flags) == {3, 4}
+  assert changes.vanished in (None, [expunged])
+  # the expunge bumped HIGHESTMODSEQ without a flag change to derive it from
+  assert changes.highestmodseq == server.highestmodseq["INBOX"]
+  again = client.resync(changes.uidvalidity, changes.highestmodseq)
+  client.close()
+  assert not again.reset and not again.flags and not again.vanished
+
+
+def test_resync_without_modseq_resets(server, open_client):
+  client = open_client(server)
+  changes = client.resync(client.uidvalidity, 0)
+  client.close()
+  assert changes.reset
+  assert changes.highestmodseq == server.highestmodseq["INBOX"]
@@ -0,0 +1,49 @@
+"""
+Archive sinks and the mbox index reading them back
+"""
+import os
+import pytest
+from mailcalaid.mail.mailclient import Message
+from mailcalaid.mail.mboxindex import MboxIndex
+from mailcalaid.mail.sinks import open_sink
+
+RAW = (
+  b"From: a@example.com\r\nSubject: hello\r\nDate: Mon, 6 Mar 2023 10:00:00 +0000\r\n\r\n"
+  b"From here on\r\n>From quoted\r\nbye\r\n"
+)
+
+
+def test_index_reverts_from_escaping(tmp_path):
+  path = str(tmp_path / "a.mbox")
+  with open_sink(path) as sink:
+    sink.add(Message(1, RAW))
+    sink.add(Message(2, RAW))
+  with MboxIndex(path) as index:
+    assert index.update() == 2
+    hits = index.search("hello")
+    assert len(hits) == 2
+    for hit in hits:
+      assert index.open(hit).msg.rstrip(b"\n") == RAW.replace(b"\r\n", b"\n").rstrip(b"\n")
+
+
+@pytest.mark.parametrize("suffix", [".mbox.gz", ".mbox.xz"])
+def test_index_refuses_compressed(tmp_path, suffix):
+  path = str(tmp_path / ("a" + suffix))
+  with open_sink(path) as sink:
+    sink.add(Message(1, RAW))
+  with MboxIndex(path) as index:
+    with pytest.raises(Exception, match="compressed"):
+      index.update()
+
+
+def test_maildir_in_existing_empty_directory(tmp_path):
+  with open_sink(str(tmp_path)) as sink:
+    sink.add(Message(1, RAW))
+  assert sorted(os.listdir(tmp_path)) == ["cur", "new", "tmp"]
+  assert len(os.listdir(tmp_path / "new")) == 1
+
+
+def test_maildir_refuses_other_directory(tmp_path):
+  (tmp_path / "notes.txt").write_text("not a Maildir")
+  with pytest.raises(Exception, match="Maildir"):
+    open_sink(str(tmp_path))
@@ -0,0 +1,40 @@
+"""
+Bounded memory aggregation of message metadata
+"""
+from datetime import datetime
+import random
+from mailcalaid.mail.mailclient import MessageMeta
+from mailcalaid.mail.stats import MailboxStats
+
+
+def meta(sender: str, size: int) -> MessageMeta:
+  return MessageMeta(0, size, datetime(2023, 3, 1), sender)
+
+
+def test_exact_below_max_keys():
+  stats = MailboxStats(max_keys=10)
+  for i in range(100):
+    stats.add(meta("u%d@example.com" % (i % 5), 10))
+  assert stats.top("sender", 1) == [("u0@example.com", 20, 200)]
+  assert stats.error("sender", "u0@example.com") == (0, 0)
+
+
+def test_heavy_hitter_bounded_error():
+  stats = MailboxStats(max_keys=50)
+  rnd = random.Random(1)
+  heavy = 0
+  for i in range(20000):
+    if i < 100 or rnd.random() < 0.25:
+      stats.add(meta("heavy@example.com", 100))
+      heavy += 1
+    else:
+      # long tail of one-off senders
+      stats.add(meta("tail%d@example.com" % i, rnd.randint(1, 150)))
+  key, count, size = stats.top("sender", 1)[0]
+  count_error, size_error = stats.error("sender", key)
+  assert key == "heavy@example.com"
+  assert size - size_error <= heavy * 100 <= size
+  assert count - count_error <= heavy
+  assert len(stats.aggregations["sender"]) == 50
+  # the tail takes over evicted entries, its numbers are marked approximate
+  assert any(stats.error("sender", k) != (0, 0) for k, _, _ in stats.top("sender", 50))